@@ -0,0 +1,130 @@
+from collections import namedtuple
+from heapq import heappop, heappush
+from itertools import count
+
+from generator import Generator, MelodyProgram, MidiEncoder
+from melody import Melody
+from metrics import Metrics
+
+
+class Part(namedtuple('Part', 'name style channel program velocities')):
+    """ one track of an Arrangement: style is 'block' (every chord tone for
+        the whole chord), 'bass' (the chord's lowest note an octave down),
+        'strum' or 'arpeggio' (the chord's fretboard voicing); velocities
+        are cycled by the beat a chord starts on
+    """
+
+    STYLES = 'block', 'bass', 'strum', 'arpeggio'
+
+
+DEFAULT_PARTS = (
+    Part('Guitar', 'strum', 0, 25, (96, 64, 80, 64)),
+    Part('Bass', 'bass', 1, 33, (100, 72)),
+)
+
+
+class Arrangement:
+    """ Multi-track MIDI of a melody string, one track and channel per Part
+
+        Chords come as a table (see table()) of plain tuples per chord: its
+        keys, its bass key and the keys of its fretboard voicing from the
+        lowest string up, so a render can run in a worker process. Strums
+        start each string STRUM_TICKS after the one before, down from the
+        lowest string on even beats and up on odd ones; arpeggios play the
+        voicing up, ARPEGGIO_DIVISION notes per melody step at the note
+        size the chord starts with. Strums and
+        arpeggios emit notes out of start order, so every part's notes go
+        through one heap keyed by start tick: a note leaves it once no
+        chord still to come can start earlier, which keeps the merge
+        O(n log n) and the heap as small as one chord's notes.
+    """
+
+    STRUM_TICKS = 20
+    ARPEGGIO_DIVISION = 2
+    TRACK_NAME = b'\xff\x03'
+    PROGRAM_CHANGE = 0xc0
+
+    def __init__(self, parts=DEFAULT_PARTS):
+        for part in parts:
+            if part.style not in Part.STYLES:
+                raise ValueError('Unknown style "{}"'.format(part.style))
+        self.parts = tuple(parts)
+
+    @staticmethod
+    def table(chords, fretboard=None):
+        """ (keys, bass key, voicing keys) of every chord; a chord without a
+            playable voicing is voiced as its notes from the lowest
+        """
+        from chord import Fretboard
+        if fretboard is None:
+            fretboard = Fretboard()
+        table = list()
+        for chord in chords:
+            keys = tuple(note.midi_key for note in chord.notes.values())
+            voicings = fretboard.voicings(chord)
+            if voicings:
+                voiced = [fretboard.note(string, fret).midi_key for string, fret in voicings[0].positions]
+            else:
+                voiced = keys
+            # the slash bass, when there is one, is the lowest key
+            table.append((keys, min(keys) - 12, tuple(sorted(voiced))))
+        return tuple(table)
+
+    def play(self, part, chord, beat, tick, length, rate):
+        """ notes of one part for one chord of the table, rate being the
+            ticks of a melody step where it starts
+        """
+        keys, bass, voiced = chord
+        velocity = part.velocities[beat % len(part.velocities)]
+        channel = part.channel
+        if part.style == 'block':
+            return [(tick, length, key, channel, velocity) for key in keys]
+        if part.style == 'bass':
+            return [(tick, length, bass, channel, velocity)]
+        if part.style == 'strum':
+            if beat % 2:
+                voiced = voiced[::-1]
+            offset = min(self.STRUM_TICKS, length // (2 * len(voiced)))
+            return [(tick + i * offset, length - i * offset, key, channel, velocity)
+                    for i, key in enumerate(voiced)]
+        step = max(1, int(rate / self.ARPEGGIO_DIVISION))
+        return [(start, min(step, tick + length - start), voiced[i % len(voiced)], channel, velocity)
+                for i, start in enumerate(range(tick, tick + length, step))]
+
+    def iter_notes(self, table, melody_str, size, ticks=MidiEncoder.TICKS_PER_QUARTER):
+        """ lazy (part index, note) of every part, in start order
+        """
+        pending = list()
+        order = count()
+        melody = MelodyProgram.parse(melody_str)
+        rate = Melody.clock(melody.sizes if melody is not None else (), size, ticks).rate
+        for beat, index, tick, length in MelodyProgram.timed(melody_str, len(table), size, ticks):
+            # chords to come start at tick or later
+            while pending and pending[0][0] < tick:
+                entry = heappop(pending)
+                yield entry[1], entry[3]
+            for part_index, part in enumerate(self.parts):
+                for note in self.play(part, table[index], beat, tick, length, rate(beat)):
+                    heappush(pending, (note[0], part_index, next(order), note))
+        while pending:
+            entry = heappop(pending)
+            yield entry[1], entry[3]
+
+    def prefix(self, part):
+        """ tick 0 events of a part's track: its name and instrument
+        """
+        name = part.name.encode('utf-8')
+        return (b'\x00' + self.TRACK_NAME + MidiEncoder.delta(len(name)) + name
+                + b'\x00' + bytes((self.PROGRAM_CHANGE | part.channel, part.program)))
+
+    def encode(self, table, melody_str, tempo=120, size=1/4, file_format=1):
+        """ the whole file: a track per part, or all parts in one for format 0
+        """
+        tracks = [list() for _ in self.parts]
+        with Metrics.timer('arrangement_notes'):
+            for part_index, note in self.iter_notes(table, melody_str, size):
+                tracks[part_index].append(note)
+        tempo, tempos = Generator.melody_tempo(melody_str, tempo, size)
+        with Metrics.timer('midi_encode'):
+            encoder = MidiEncoder(tempo, file_format, tempos=tempos)
+            return encoder.encode(tracks, [self.prefix(part) for part in self.parts])
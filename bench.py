@@ -0,0 +1,446 @@
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from chord import Fretboard, Tuning
+from generator import Generator, MelodyProgram
+from note import Note
+from parser import ChordParser, corpus
+
+TUNINGS = 'EBGDAE', 'DAGDAD', 'EBG#DAE', 'EADG'
+CHORDS = 'Am Dm G C F Bb E7 Am9 Dm7'
+MELODY = '1_2.3__4 5-6.7_8 9...1-2-'
+# a hot path may lose this much throughput (or gain this much peak memory)
+THRESHOLD = 0.25
+# peak memory noise allowed on top of THRESHOLD
+MEMORY_SLACK = 64 << 10
+# module -> (cumulative import time budget in ms, modules it must not import),
+# for short-lived workers and CLI runs; numpy, telegram and midiutil load
+# on first use
+IMPORT_BUDGETS = {
+    'note': (5, ()),
+    'parser': (30, ('numpy', 'telegram', 'midiutil')),
+    'chord_table': (30, ('numpy', 'telegram', 'midiutil')),
+    'generator': (40, ('numpy', 'telegram', 'midiutil')),
+    'workers': (40, ('numpy', 'telegram', 'midiutil')),
+    'bot': (80, ('numpy', 'telegram', 'midiutil')),
+}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def melody(length):
+    return (MELODY * (length // len(MELODY) + 1))[:length]
+
+
+def melodies(count, seed=0, length=(16, 64), chords=3):
+    rng = random.Random(seed)
+    digits = '123456789'[:chords]
+    return [rng.choice(digits) + ''.join(rng.choice(digits + '.-_') for _ in range(rng.randint(*length) - 1))
+            for _ in range(count)]
+
+
+class Workload:
+    """ A named, reproducible piece of work: run() does `ops` operations,
+        setup() (if any) runs untimed before every round
+    """
+
+    def __init__(self, name, run, ops, rounds=20, setup=None):
+        self.name = name
+        self.run = run
+        self.ops = ops
+        self.rounds = rounds
+        self.setup = setup
+
+    def measure(self):
+        """ throughput (ops/s, median round), per-op latency percentiles
+            (seconds) over the rounds and peak traced bytes of one round
+        """
+        if self.setup is not None:
+            self.setup()
+        self.run()
+        seconds = list()
+        for _ in range(self.rounds):
+            if self.setup is not None:
+                self.setup()
+            start = time.perf_counter()
+            self.run()
+            seconds.append(time.perf_counter() - start)
+        if self.setup is not None:
+            self.setup()
+        tracemalloc.start()
+        self.run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return dict(
+            ops=self.ops,
+            rounds=self.rounds,
+            throughput=round(self.ops / percentile(seconds, 0.5), 3),
+            p50=percentile(seconds, 0.5) / self.ops,
+            p90=percentile(seconds, 0.9) / self.ops,
+            p99=percentile(seconds, 0.99) / self.ops,
+            peak_bytes=peak,
+        )
+
+
+def workloads():
+    """ the suite: parser and builder over the corpus, Note arithmetic,
+        fretboard queries across tunings, MIDI over short and very long
+        melodies, a multi-track arrangement and a song of repeated sections
+    """
+    symbols = corpus()
+    parsed = list()
+    chords = list()
+    for symbol in symbols:
+        try:
+            parsed.append(ChordParser.parse(symbol))
+            chords.append(ChordParser.chord(symbol))
+        except ValueError:
+            continue
+    names = [[note.key for note in chord.steps.values()] for chord in chords]
+    fretboards = [Fretboard(Tuning(tuning)) for tuning in TUNINGS]
+    notes = [Note(key, octave) for octave in range(4) for key in Note.NAMES[0]]
+    steps = range(-12, 13)
+
+    def parse():
+        for symbol in symbols:
+            try:
+                ChordParser.parse(symbol)
+            except ValueError:
+                pass
+
+    def build():
+        for symbol in parsed:
+            ChordParser.build(symbol)
+
+    def note_arithmetic():
+        for note in notes:
+            for step in steps:
+                note + step
+                note - step
+
+    def note_spelling():
+        for note in notes:
+            note.major
+            note.minor
+            note.midi_key
+            note.frequency
+
+    def find_chord():
+        for fretboard in fretboards:
+            for chord in chords:
+                fretboard.find_chord(chord)
+
+    def get_schema():
+        for fretboard in fretboards:
+            for chord_names in names:
+                fretboard.get_schema(chord_names)
+
+    gen = Generator(CHORDS)
+    short = melodies(200)
+    long = melody(200000)
+    arranged = melody(20000)
+    # about 350 bars of 8 beats from a few bars of source
+    song = 'intro{1___2___} verse{(1_2_3_4_)x2 5_6_7_8_} chorus{(9___6___)x2} intro (verse chorus)x70'
+
+    def midi_short():
+        for melody_str in short:
+            gen.midi(melody_str)
+
+    def clear_programs():
+        Generator.programs.clear()
+        MelodyProgram.melodies.clear()
+
+    def write_midi_long():
+        with tempfile.TemporaryFile() as f:
+            gen.write_midi(long, f)
+
+    return [
+        Workload('parse', parse, len(symbols)),
+        Workload('build', build, len(parsed)),
+        Workload('note_arithmetic', note_arithmetic, 2 * len(notes) * len(steps)),
+        Workload('note_spelling', note_spelling, len(notes)),
+        Workload('find_chord', find_chord, len(fretboards) * len(chords)),
+        Workload('get_schema', get_schema, len(fretboards) * len(names)),
+        Workload('get_schema_cold', get_schema, len(fretboards) * len(names), setup=Fretboard.diagrams.clear),
+        Workload('midi_short', midi_short, len(short), setup=Generator.programs.clear),
+        Workload('midi_long', lambda: gen.midi(long), 1, rounds=3),
+        Workload('write_midi_long', write_midi_long, 1, rounds=3),
+        Workload('arrange', lambda: gen.arrange(arranged), 1, rounds=3),
+        Workload('melody_song', lambda: gen.midi(song), 1, setup=clear_programs),
+    ]
+
+
+def run(names=None):
+    """ measure() of every workload (or those named), by name
+    """
+    return {workload.name: workload.measure() for workload in workloads()
+            if names is None or workload.name in names}
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(dict(python=platform.python_version(), machine=platform.machine(), results=results),
+                  f, indent=1, sort_keys=True)
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """ (workload, metric, baseline, now) of every result worse than the
+        baseline by more than threshold: lower throughput or higher peak
+        memory
+    """
+    regressions = list()
+    for name, base in sorted(baseline['results'].items()):
+        now = results.get(name)
+        if now is None:
+            continue
+        if now['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append((name, 'throughput', base['throughput'], now['throughput']))
+        if now['peak_bytes'] > base['peak_bytes'] * (1 + threshold) + MEMORY_SLACK:
+            regressions.append((name, 'peak_bytes', base['peak_bytes'], now['peak_bytes']))
+    return regressions
+
+
+def report(results):
+    lines = ['{:<16} {:>14} {:>10} {:>10} {:>10} {:>10}'.format(
+        'workload', 'ops/s', 'p50 us', 'p90 us', 'p99 us', 'peak KB')]
+    for name, result in results.items():
+        lines.append('{:<16} {:>14.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f}'.format(
+            name, result['throughput'], result['p50'] * 1e6, result['p90'] * 1e6, result['p99'] * 1e6,
+            result['peak_bytes'] / 1024))
+    return '\n'.join(lines)
+
+
+def import_time(module, runs=3):
+    """ best cumulative seconds of `import module` in a fresh interpreter
+        (per python -X importtime) and the modules it imported
+    """
+    code = 'import sys; before = set(sys.modules); import {}; print("\\n".join(set(sys.modules) - before))'.format(module)
+    best = None
+    imported = set()
+    # the first run may be writing .pyc files
+    for _ in range(runs + 1):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        imported = set(result.stdout.split())
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].rstrip() == ' ' + module:
+                seconds = int(fields[1]) / 1e6
+                best = seconds if best is None else min(best, seconds)
+    return best, imported
+
+
+def check_imports(budgets=None):
+    """ (module, import seconds, budget seconds, forbidden modules it
+        imported, ok) per module of IMPORT_BUDGETS
+    """
+    rows = list()
+    for module, (budget, forbidden) in (budgets or IMPORT_BUDGETS).items():
+        seconds, imported = import_time(module)
+        found = sorted(name for name in forbidden if name in imported)
+        rows.append((module, seconds, budget / 1000, found, seconds <= budget / 1000 and not found))
+    return rows
+
+
+class ReplayUser:
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = 'user{}'.format(user_id)
+
+    def mention_markdown_v2(self):
+        return self.first_name
+
+
+class ReplayDocument:
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class ReplayMessage:
+    """ just enough of telegram.Message for ChordBot's handlers: replies
+        are recorded as (kind, text or filename, bytes) instead of sent
+    """
+
+    def __init__(self, user, text, replies):
+        self.from_user = user
+        self.text = text
+        self.replies = replies
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(('text', text, 0))
+        return self
+
+    async def reply_markdown_v2(self, text, **kwargs):
+        return await self.reply_text(text)
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        if hasattr(document, 'read'):
+            document = document.read()
+        if isinstance(document, str):
+            # a file_id of an earlier upload
+            self.replies.append(('file_id', document, 0))
+        else:
+            self.replies.append(('document', filename, len(document)))
+        reply = ReplayMessage(self.from_user, None, self.replies)
+        reply.document = ReplayDocument('replay{}'.format(len(self.replies)))
+        return reply
+
+
+class ReplayUpdate:
+
+    def __init__(self, user, message):
+        self.effective_user = user
+        self.message = message
+
+
+class ReplayContext:
+
+    def __init__(self, args):
+        self.args = args
+
+
+def synthetic_messages(users=200, melodies_per_user=5, seed=0):
+    """ a stream like bot.Recorder writes: every user sets chords (and
+        maybe tempo and size), then sends melodies, users interleaved
+    """
+    rng = random.Random(seed)
+    symbols = list()
+    for symbol in corpus():
+        try:
+            ChordParser.chord(symbol)
+        except ValueError:
+            continue
+        symbols.append(symbol)
+    streams = list()
+    for user_id in range(1, users + 1):
+        chords = rng.randint(2, 9)
+        texts = ['/chords ' + ' '.join(rng.choice(symbols) for _ in range(chords))]
+        if rng.random() < 0.3:
+            texts.append('/tempo {}'.format(rng.choice((80, 96, 120, 140))))
+        if rng.random() < 0.3:
+            texts.append('/size {}'.format(rng.choice(('1/8', '1/4', '1/2'))))
+        texts.extend(melodies(melodies_per_user, seed=rng.random(), chords=chords))
+        streams.append([dict(user=user_id, text=text) for text in texts])
+    messages = list()
+    while streams:
+        for stream in list(streams):
+            messages.append(stream.pop(0))
+            if not stream:
+                streams.remove(stream)
+    return messages
+
+
+async def replay(messages, concurrency=64):
+    """ feed messages ({"user": id, "text": ...} as bot.Recorder writes
+        them) to ChordBot's handlers offline, up to `concurrency` at once,
+        in order per user; handling latencies, replies and errors
+    """
+    from bot import COMMANDS, ChordBot
+    from midi_cache import MidiCache
+    from render_pool import RenderPool
+    from session_store import SessionStore
+
+    state = ChordBot.sessions, ChordBot.midi_cache, ChordBot.pool
+    ChordBot.sessions = SessionStore()
+    ChordBot.midi_cache = MidiCache()
+    ChordBot.pool = RenderPool()
+    slots = asyncio.Semaphore(concurrency)
+    users = dict()
+    replies = list()
+    latencies = list()
+    errors = list()
+
+    async def handle(message):
+        user = users.get(message['user'])
+        if user is None:
+            user = users[message['user']] = ReplayUser(message['user'])
+        text = message['text']
+        handler = ChordBot.get_midi
+        args = None
+        if text.startswith('/'):
+            words = text.split()
+            command = words[0][1:].split('@')[0]
+            if command in COMMANDS:
+                handler = COMMANDS[command]
+                args = words[1:]
+        update = ReplayUpdate(user, ReplayMessage(user, text, replies))
+        async with slots:
+            start = time.perf_counter()
+            try:
+                await handler(update, ReplayContext(args))
+            except Exception as e:
+                errors.append('{}: {!r}'.format(text[:64], e))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(handle(message) for message in messages))
+    finally:
+        ChordBot.pool.shutdown()
+        ChordBot.sessions, ChordBot.midi_cache, ChordBot.pool = state
+    seconds = time.perf_counter() - start
+    kinds = dict()
+    for kind, text, size in replies:
+        kinds[kind] = kinds.get(kind, 0) + 1
+    return dict(
+        messages=len(messages),
+        seconds=round(seconds, 3),
+        throughput=round(len(messages) / seconds, 1),
+        p50=percentile(latencies, 0.5) if latencies else 0,
+        p99=percentile(latencies, 0.99) if latencies else 0,
+        replies=kinds,
+        errors=errors,
+    )
+
+
+def load_messages(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+    # python bench.py                          run the suite
+    # python bench.py save BASELINE            run it and store the results
+    # python bench.py check BASELINE [THRESHOLD]  run it, exit 1 on regressions
+    # python bench.py replay [MESSAGES]        replay a recorded (or synthetic) message stream
+    # python bench.py imports                  exit 1 if an import is over budget
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'imports':
+        rows = check_imports()
+        for module, seconds, budget, found, ok in rows:
+            print('{:<12} {:>7.1f} ms / {:>4.0f} ms {}{}'.format(
+                module, seconds * 1e3, budget * 1e3, 'ok' if ok else 'OVER BUDGET',
+                ' imports ' + ', '.join(found) if found else ''))
+        sys.exit(0 if all(row[-1] for row in rows) else 1)
+    if command == 'replay':
+        messages = load_messages(sys.argv[2]) if len(sys.argv) > 2 else synthetic_messages()
+        result = asyncio.run(replay(messages))
+        errors = result.pop('errors')
+        print(result)
+        for error in errors[:10]:
+            print(error)
+        sys.exit(1 if errors else 0)
+    results = run()
+    print(report(results))
+    if command == 'save':
+        save(results, sys.argv[2])
+    elif command == 'check':
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, float(sys.argv[3]) if len(sys.argv) > 3 else THRESHOLD)
+        for name, metric, base, now in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, metric, base, now))
+        sys.exit(1 if regressions else 0)
@@ -1,8 +1,30 @@
+from __future__ import annotations
+
+import asyncio
+import json
 import logging
 import os
-from telegram import Update, ForceReply
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
-from generator import Generator
+import queue
+import re
+import threading
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from typing import TYPE_CHECKING
+from chord import Fretboard
+from chord_table import ChordTable
+from generator import Generator, MelodyProgram, render, render_arrangement, render_wav
+from metrics import Metrics
+from midi_cache import MidiCache
+from parser import ChordParser
+from render_pool import PoolBusy, RenderPool
+from session_store import SessionStore, SqliteBackend
+from workers import JobTimeout, WorkerPool
+
+if TYPE_CHECKING:
+    # python-telegram-bot is imported when the application is built
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 # Enable logging
 logging.basicConfig(
@@ -15,23 +37,24 @@ messages = dict()
 
 # Define a few command handlers. These usually take the two arguments update and
 # context.
-def start(update: Update, context: CallbackContext) -> None:
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
+    from telegram import ForceReply
     user = update.effective_user
-    update.message.reply_markdown_v2(
+    await update.message.reply_markdown_v2(
         fr'Hi {user.mention_markdown_v2()}\!',
         reply_markup=ForceReply(selective=True),
     )
 
 
-def help_command(update: Update, context: CallbackContext) -> None:
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     help_text = """
     Generate midi with chords set:
     
     1. create chordset, e.g.: 
        /chords Am Dm E
-       Only 9 chords are available in chordset!
+       Chords after the 9th are [10], [11]... in melodies
        
     2. (optional) set tempo, e.g.: 
        /tempo 96
@@ -44,60 +67,398 @@ def help_command(update: Update, context: CallbackContext) -> None:
        . means "no sound" / "stop chord"
        - means "sustain on" / "keep playing chord"
        1-9 are the chords, by order starting from 1 (1 is Am for "Am Dm E")
+       (1_2_)x8 plays 1_2_ eight times
+       verse{1_2_3_} names a part, "verse" plays it again, "versex2" twice
+       <tempo=96> and <size=1/8> change tempo and size from there on
     
     5. Open MIDI file in your preferred DAW 
+       or get it as audio, e.g.:
+       /wav 1...2---3.3.
+       or arranged for strummed guitar and bass, e.g.:
+       /arrange 1...2---3.3.
     """
-    update.message.reply_text(help_text)
+    await update.message.reply_text(help_text)
 
 
 class ChordBot:
 
-    user_settings = dict()
+    sessions = SessionStore()
+    midi_cache = MidiCache()
+    pool = RenderPool()
+    BUSY_TEXT = 'Too many melodies at once, please send it again in a moment'
+    ERROR_TEXT = 'Something went wrong with that melody, please try again'
+    MAX_ERROR_TEXT = 200
+    # beats a melody may play, repeats and sections played out: as many as
+    # a plain melody gets into one message (4096 characters)
+    MAX_BEATS = 4096
+    # characters file systems (or Telegram clients) refuse in file names
+    UNSAFE_FILENAME = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+    MAX_FILENAME = 64
+
+    # user id -> [lock, holders and waiters]
+    _user_locks = dict()
+    # cache key -> task rendering it, shared by identical requests
+    _renders = dict()
+
+    @classmethod
+    async def _reply_error(cls, update, e):
+        """ tell the user why a command or render failed: melody and
+            setting errors as they are (cut short, they quote the input),
+            anything else with a short generic reply
+        """
+        if isinstance(e, PoolBusy):
+            Metrics.count('busy')
+            text = cls.BUSY_TEXT
+        elif isinstance(e, JobTimeout):
+            Metrics.count('render_timeout')
+            text = 'That melody took too long to render'
+        elif isinstance(e, IndexError):
+            text = 'The melody uses a chord number past the end of your chordset'
+        elif isinstance(e, KeyError):
+            text = 'The melody holds ("_" or "-") before its first chord'
+        elif isinstance(e, ValueError):
+            # MelodyError included
+            text = str(e)
+        else:
+            logger.error('Render failed', exc_info=e)
+            Metrics.count('render_error')
+            text = cls.ERROR_TEXT
+        await cls._reply_short(update, text)
+
+    @classmethod
+    async def _reply_short(cls, update, text):
+        """ reply with text cut to MAX_ERROR_TEXT characters
+        """
+        if len(text) > cls.MAX_ERROR_TEXT:
+            text = text[:cls.MAX_ERROR_TEXT - 1] + '…'
+        await update.message.reply_text(text)
+
+    @classmethod
+    def _filename(cls, melody_str, extension):
+        """ file name of a render of melody_str: unsafe characters become
+            "_", and it is cut to MAX_FILENAME characters
+        """
+        name = cls.UNSAFE_FILENAME.sub('_', melody_str)[:cls.MAX_FILENAME].strip(' .')
+        return '{}.{}'.format(name or 'melody', extension)
 
     @classmethod
-    def _get_generator(cls, user):
-        if cls.user_settings.get(user) is None:
-            cls.user_settings[user] = Generator()
-        return cls.user_settings[user]
+    def _check_length(cls, melody_str):
+        """ ValueError for a melody longer than MAX_BEATS
+        """
+        beats = Generator.melody_length(melody_str)
+        if beats > cls.MAX_BEATS:
+            raise ValueError('The melody plays {} beats, more than {}'.format(beats, cls.MAX_BEATS))
 
     @classmethod
-    def set_chords(cls, update: Update, context: CallbackContext):
-        gen = cls._get_generator(update.effective_user)
-        gen.set_chords(' '.join(context.args))
+    async def _get_generator(cls, user):
+        gen = cls.sessions.cached(user.id)
+        if gen is None:
+            gen = await cls._io_call(cls.sessions.backend.blocking, cls.sessions.load, user.id)
+        return gen
+
+    @classmethod
+    async def _save_generator(cls, user, gen):
+        await cls._io_call(cls.sessions.backend.blocking, cls.sessions.save, user.id, gen)
+
+    @staticmethod
+    async def _io_call(blocking, function, *args):
+        """ runs a session store or MIDI cache call, in a thread if it
+            blocks on the disk
+        """
+        if not blocking:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
 
     @classmethod
-    def set_tempo(cls, update: Update, context: CallbackContext):
-        gen = cls._get_generator(update.effective_user)
-        gen.set_tempo(' '.join(context.args))
+    @asynccontextmanager
+    async def user_lock(cls, user):
+        """ serializes the handling of one user's messages
+        """
+        entry = cls._user_locks.get(user.id)
+        if entry is None:
+            entry = cls._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del cls._user_locks[user.id]
 
     @classmethod
-    def set_size(cls, update: Update, context: CallbackContext):
-        gen = cls._get_generator(update.effective_user)
-        gen.set_size(' '.join(context.args))
+    async def set_chords(cls, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with cls.user_lock(update.effective_user):
+            gen = await cls._get_generator(update.effective_user)
+            skipped = gen.set_chords(' '.join(context.args))
+            await cls._save_generator(update.effective_user, gen)
+            if skipped:
+                await cls._reply_short(update, 'No chord for {}'.format(
+                    ', '.join('"{}"'.format(symbol) for symbol in skipped)))
 
     @classmethod
-    def get_midi(cls, update: Update, context: CallbackContext):
+    async def set_tempo(cls, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with cls.user_lock(update.effective_user):
+            gen = await cls._get_generator(update.effective_user)
+            try:
+                gen.set_tempo(' '.join(context.args))
+            except ValueError as e:
+                await cls._reply_error(update, e)
+                return
+            await cls._save_generator(update.effective_user, gen)
+
+    @classmethod
+    async def set_size(cls, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with cls.user_lock(update.effective_user):
+            gen = await cls._get_generator(update.effective_user)
+            try:
+                gen.set_size(' '.join(context.args))
+            except ValueError as e:
+                await cls._reply_error(update, e)
+                return
+            await cls._save_generator(update.effective_user, gen)
+
+    @classmethod
+    async def get_midi(cls, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        Metrics.count('melody')
+        async with cls.user_lock(update.effective_user):
+            try:
+                await cls._send_midi(update)
+            except Exception as e:
+                await cls._reply_error(update, e)
+
+    @classmethod
+    async def get_wav(cls, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        Metrics.count('wav')
+        async with cls.user_lock(update.effective_user):
+            melody_str = ' '.join(context.args)
+            gen = await cls._get_generator(update.effective_user)
+            if not gen.chords:
+                await update.message.reply_text('Please make chordset first ("/chords Am Dm...")')
+                return
+            settings = gen.pitch_table(), melody_str, gen.tempo, gen.size
+            try:
+                cls._check_length(melody_str)
+                with Metrics.timer('render_wait'):
+                    data = await cls.pool.run(render_wav, *settings, shard=update.effective_user.id)
+            except Exception as e:
+                await cls._reply_error(update, e)
+                return
+            with Metrics.timer('telegram_send'):
+                await update.message.reply_document(data, filename=cls._filename(melody_str, 'wav'))
+
+    @classmethod
+    async def get_arrangement(cls, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        Metrics.count('arrange')
+        async with cls.user_lock(update.effective_user):
+            melody_str = ' '.join(context.args)
+            gen = await cls._get_generator(update.effective_user)
+            if not gen.chords:
+                await update.message.reply_text('Please make chordset first ("/chords Am Dm...")')
+                return
+            settings = gen.arrangement_table(), melody_str, gen.tempo, gen.size
+            try:
+                cls._check_length(melody_str)
+                with Metrics.timer('render_wait'):
+                    data = await cls.pool.run(render_arrangement, *settings, shard=update.effective_user.id)
+            except Exception as e:
+                await cls._reply_error(update, e)
+                return
+            with Metrics.timer('telegram_send'):
+                await update.message.reply_document(data, filename=cls._filename(melody_str, 'mid'))
+
+    @classmethod
+    async def _send_midi(cls, update):
         melody_str = update.message.text
-        gen = cls._get_generator(update.effective_user)
+        gen = await cls._get_generator(update.effective_user)
         if not gen.chords:
-            update.message.reply_text('Please make chordset first ("/chords Am Dm...")')
-        update.message.reply_document(gen.midi(melody_str), filename='{}.mid'.format(melody_str))
+            await update.message.reply_text('Please make chordset first ("/chords Am Dm...")')
+            return
+        filename = cls._filename(melody_str, 'mid')
+        key = gen.cache_key(melody_str)
+        file_id = cls.midi_cache.file_id(key, filename)
+        if file_id is not None:
+            Metrics.count('file_id_reuse')
+            with Metrics.timer('telegram_send'):
+                await update.message.reply_document(file_id)
+            return
+        cls._check_length(melody_str)
+        settings = gen.pitch_table(), melody_str, gen.tempo, gen.size
+        data = cls.midi_cache.cached(key)
+        if data is None:
+            data = await cls._io_call(cls.midi_cache.blocking, cls.midi_cache.get, key)
+        if data is None:
+            data = await cls._render(key, settings, update.effective_user.id)
+        with Metrics.timer('telegram_send'):
+            message = await update.message.reply_document(data, filename=filename)
+        cls.midi_cache.set_file_id(key, filename, message.document.file_id)
+
+    @classmethod
+    async def _render(cls, key, settings, shard):
+        task = cls._renders.get(key)
+        if task is None:
+            task = cls._renders[key] = asyncio.ensure_future(cls._render_and_cache(key, settings, shard))
+            task.add_done_callback(lambda task: cls._renders.pop(key, None))
+        else:
+            Metrics.count('render_coalesced')
+        return await asyncio.shield(task)
+
+    @classmethod
+    async def _render_and_cache(cls, key, settings, shard):
+        with Metrics.timer('render_wait'):
+            data = await cls.pool.run(render, *settings, shard=shard)
+        await cls._io_call(cls.midi_cache.blocking, cls.midi_cache.put, key, data)
+        return data
+
+
+# command -> handler; any other text is a melody for ChordBot.get_midi
+COMMANDS = {
+    "start": start,
+    "help": help_command,
+    "chords": ChordBot.set_chords,
+    "tempo": ChordBot.set_tempo,
+    "size": ChordBot.set_size,
+    "wav": ChordBot.get_wav,
+    "arrange": ChordBot.get_arrangement,
+}
+
+
+class Recorder:
+    """ handler appending every text message to a JSON lines file, the
+        stream bench.replay() plays back
+
+        Handlers only queue the lines: a thread writes whatever queued up
+        meanwhile in one go and flushes it, so the file I/O stays off the
+        event loop. close() writes the rest and closes the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.monotonic()
+        self._lines = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write, name="recorder", daemon=True)
+        self._writer.start()
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if update.message is not None and update.message.text is not None:
+            self._lines.put(json.dumps(dict(
+                time=round(time.monotonic() - self.start, 3),
+                user=update.effective_user.id,
+                text=update.message.text,
+            )) + "\n")
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._lines.put(None)
+            self._writer.join()
+
+    async def post_shutdown(self, application) -> None:
+        self.close()
+
+    def _write(self) -> None:
+        with open(self.path, "a", encoding="utf-8") as log:
+            while True:
+                # None, queued by close(), ends the batch and the thread
+                batch = [self._lines.get()]
+                while batch[-1] is not None and not self._lines.empty():
+                    batch.append(self._lines.get())
+                done = batch[-1] is None
+                log.writelines(batch[:-1] if done else batch)
+                log.flush()
+                if done:
+                    return
+
+
+def serve_metrics(address):
+    """ Metrics of the bot, its caches, sessions and pool at
+        http://address/metrics ("host:port" or a port on localhost)
+    """
+    host, colon, port = address.rpartition(":")
+    Metrics.collect("sessions", lambda: dict(ChordBot.sessions.stats, stored=len(ChordBot.sessions.backend)))
+    Metrics.collect("midi_cache", lambda: ChordBot.midi_cache.stats)
+    Metrics.collect("pool", lambda: ChordBot.pool.stats)
+    Metrics.collect("programs", lambda: Generator.programs.stats)
+    Metrics.collect("melodies", lambda: MelodyProgram.melodies.stats)
+    Metrics.collect("chord_cache", lambda: ChordParser.cache.stats)
+    Metrics.collect("diagrams", lambda: Fretboard.diagrams.stats)
+    Metrics.collect("users_waiting", lambda: dict(users=len(ChordBot._user_locks), renders=len(ChordBot._renders)))
+    return Metrics.serve(int(port), host or "127.0.0.1")
+
+
+def build_application(token, base_url=None, concurrency=64, connections=None, http_version=None, record=None):
+    """ the bot's Application; up to `concurrency` updates are handled at once
+
+        Replies share one keep-alive connection pool of `connections`
+        (256 by default); http_version "2" multiplexes them over fewer
+        connections (needs python-telegram-bot[http2]). Incoming messages
+        are appended to the file `record` names, if any.
+    """
+    from telegram import Update
+    from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters
+    builder = Application.builder().token(token).concurrent_updates(concurrency)
+    recorder = Recorder(record) if record is not None else None
+    if recorder is not None:
+        builder = builder.post_shutdown(recorder.post_shutdown)
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    if connections is not None:
+        builder = builder.connection_pool_size(connections)
+    if http_version is not None:
+        builder = builder.http_version(http_version)
+    application = builder.build()
+
+    if recorder is not None:
+        application.add_handler(TypeHandler(Update, recorder), group=-1)
+    for command, handler in COMMANDS.items():
+        application.add_handler(CommandHandler(command, handler))
+    application.add_handler(MessageHandler(filters.TEXT, ChordBot.get_midi))
+    return application
 
 
 def main() -> None:
     """Start the bot."""
-    updater = Updater(os.environ.get("chord_bot_token"))
-    dispatcher = updater.dispatcher
-
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("chords", ChordBot.set_chords))
-    dispatcher.add_handler(CommandHandler("tempo", ChordBot.set_tempo))
-    dispatcher.add_handler(CommandHandler("size", ChordBot.set_size))
-    dispatcher.add_handler(MessageHandler(Filters.text, ChordBot.get_midi))
-
-    updater.start_polling()
-    updater.idle()
+    ChordParser.table = ChordTable.load()
+    ChordBot.midi_cache = MidiCache(os.environ.get("chord_bot_cache"))
+    if os.environ.get("chord_bot_sessions"):
+        ChordBot.sessions = SessionStore(SqliteBackend(os.environ["chord_bot_sessions"]))
+    if os.environ.get("chord_bot_metrics"):
+        serve_metrics(os.environ["chord_bot_metrics"])
+    pending = int(os.environ["chord_bot_pending"]) if "chord_bot_pending" in os.environ else None
+    if os.environ.get("chord_bot_listen"):
+        # rendering by worker processes, which may run on other machines too
+        authkey = os.environ.get("chord_bot_authkey")
+        ChordBot.pool = WorkerPool(
+            workers=int(os.environ["chord_bot_workers"]) if "chord_bot_workers" in os.environ else None,
+            address=os.environ["chord_bot_listen"],
+            authkey=authkey.encode() if authkey else None,
+            pending=pending,
+            job_timeout=float(os.environ.get("chord_bot_job_timeout", 60)),
+        )
+    else:
+        ChordBot.pool = RenderPool(
+            workers=int(os.environ.get("chord_bot_workers", 0)) or None,
+            processes=os.environ.get("chord_bot_processes") == "1",
+            pending=pending,
+        )
+    application = build_application(
+        os.environ.get("chord_bot_token"),
+        concurrency=int(os.environ.get("chord_bot_concurrency", 64)),
+        connections=int(os.environ["chord_bot_connections"]) if "chord_bot_connections" in os.environ else None,
+        http_version=os.environ.get("chord_bot_http_version"),
+        record=os.environ.get("chord_bot_record"),
+    )
+    webhook_url = os.environ.get("chord_bot_webhook")
+    if webhook_url:
+        # Telegram posts updates to webhook_url, served here (behind a proxy doing TLS)
+        application.run_webhook(
+            listen=os.environ.get("chord_bot_webhook_listen", "0.0.0.0"),
+            port=int(os.environ.get("chord_bot_webhook_port", 8443)),
+            url_path=urlsplit(webhook_url).path.lstrip("/"),
+            webhook_url=webhook_url,
+            secret_token=os.environ.get("chord_bot_webhook_secret"),
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
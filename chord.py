@@ -1,6 +1,93 @@
+import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from lru import LRUCache
 from note import Note
 
 
+logger = logging.getLogger(__name__)
+
+CompiledChord = namedtuple('CompiledChord', 'steps is_minor')
+
+
+class TraceEvent(namedtuple('TraceEvent', 'operation step note detail')):
+
+    FORMATS = {
+        'parse': '{note}',
+        'alias': 'Pattern "{detail[0]}": Replaced {detail[1]} to {detail[2]}',
+        'tonic': ' {step} {note} tonic',
+        'added': ' {step} {note} added',
+        'enlarged': '♯{step} {note} enlarged',
+        'reduced': '♭{step} {note} reduced',
+        'missing': 'no step {step} to {detail}',
+        'suspended': ' {step} {note} suspended to {detail}',
+        'omitted': ' {step} {note} omitted',
+        'built': '→ {note}',
+    }
+
+    def __str__(self):
+        return self.FORMATS[self.operation].format(**self._asdict())
+
+
+class BuildTrace:
+    """ Build-trace hook for ChordBuilder and ChordParser
+
+        Off by default: call sites check BuildTrace.enabled before building
+        an event, so a disabled trace costs one attribute lookup.
+        Subscribers get TraceEvent(operation, step, note, detail) objects;
+        str(event) is the line the old debug prints used to write.
+    """
+
+    enabled = False
+    callbacks = list()
+
+    @classmethod
+    def subscribe(cls, callback):
+        cls.callbacks.append(callback)
+        cls.enabled = True
+        return callback
+
+    @classmethod
+    def unsubscribe(cls, callback):
+        if callback in cls.callbacks:
+            cls.callbacks.remove(callback)
+        cls.enabled = bool(cls.callbacks)
+
+    @classmethod
+    def emit(cls, operation, step=None, note=None, detail=None):
+        event = TraceEvent(operation, step, note, detail)
+        for callback in list(cls.callbacks):
+            callback(event)
+
+    @classmethod
+    def log(cls, level=logging.DEBUG, log=logger):
+        """ subscribe the logging module; returns the callback to unsubscribe
+        """
+        def callback(event):
+            if log.isEnabledFor(level):
+                log.log(level, '%s', event, extra=dict(trace=event))
+        return cls.subscribe(callback)
+
+    @classmethod
+    @contextmanager
+    def capture(cls):
+        """ collect events emitted by the current thread
+        """
+        events = list()
+        thread = threading.get_ident()
+
+        def callback(event):
+            if threading.get_ident() == thread:
+                events.append(event)
+
+        cls.subscribe(callback)
+        try:
+            yield events
+        finally:
+            cls.unsubscribe(callback)
+
+
 class Tuning:
 
     DEFAULT_OCTAVE_ORDER = 2, 1, 1, 1, 0
@@ -43,8 +130,105 @@ class Tuning:
         return self.strings[item]
 
 
+class DiagramCache(LRUCache):
+    """ Bounded thread-safe LRU of Fretboard.get_schema and draw_chord diagrams
+
+        Keys are (tuning, fret range, note names or positions shown,
+        highlight roles), tunings by their open pitches. Diagrams are
+        assembled from a per-tuning strings x frets grid of note-name cells,
+        built once; entries are tuples of rows.
+    """
+
+    # every key a note is spelled with, major or minor
+    NAMES = tuple(dict.fromkeys(Note.NAMES[0] + Note.NAMES[1]))
+    FRETS = 24
+
+    def __init__(self, maxsize=4096):
+        super().__init__(maxsize)
+        # open pitches -> (lowest fret, highest fret, grid)
+        self._grids = dict()
+
+    def cells(self, tuning, start, end):
+        """ (major key, cell, minor key, cell) of frets start..end on every
+            string, highest string first as diagrams are drawn
+        """
+        strings = list(tuning)
+        pitches = tuple(note.pitch for note in strings)
+        entry = self._grids.get(pitches)
+        if entry is None or start < entry[0] or end > entry[1]:
+            low = min(start, 0) if entry is None else min(start, entry[0])
+            high = max(end, self.FRETS) if entry is None else max(end, entry[1])
+            grid = [[(note.major.key, ' {}'.format(note.major).rjust(4),
+                      note.minor.key, ' {}'.format(note.minor).rjust(4))
+                     for note in (string + fret for fret in range(low, high + 1))]
+                    for string in reversed(strings)]
+            entry = self._grids[pitches] = low, high, grid
+        low, high, grid = entry
+        return [row[start - low:end - low + 1] for row in grid]
+
+    def schema(self, tuning, notes, start, end):
+        # only which note names are in `notes` matters
+        names = frozenset(name for name in self.NAMES if name in notes)
+        key = 'schema', tuple(note.pitch for note in tuning), start, end, names
+        rows = self.get(key)
+        if rows is None:
+            rows = list()
+            for row in self.cells(tuning, start, end):
+                rows.append('|'.join(major_cell if major in names else minor_cell if minor in names else '    '
+                                     for major, major_cell, minor, minor_cell in row))
+            rows.append(' '.join('{}'.format(i).rjust(4) for i in range(start, end + 1)))
+            rows = self.put(key, tuple(rows))
+        return list(rows)
+
+    def chord(self, tuning, positions, chord, fret_min, fret_max):
+        steps = chord.steps
+        roles = tuple(steps[step].major.key if steps.get(step) is not None else None for step in (3, 7))
+        roles = (chord.tonic.major.key,) + roles
+        positions = frozenset(positions)
+        key = 'chord', tuple(note.pitch for note in tuning), fret_min, fret_max, positions, roles
+        rows = self.get(key)
+        if rows is None:
+            tonic, third, seventh = roles
+            rows = list()
+            strings = self.cells(tuning, fret_min, fret_max + 1)
+            for n, row in zip(range(len(strings), 0, -1), strings):
+                string = list()
+                found = False
+                for i, (major, major_cell, minor, minor_cell) in enumerate(row, fret_min):
+                    if (n, i) in positions:
+                        if major == tonic:
+                            template = '`{} '
+                        elif major == third:
+                            template = '³{} '
+                        elif major == seventh:
+                            template = '⁷{} '
+                        else:
+                            template = ' {} '
+                        symb = template.format(n)
+                        found = True
+                    else:
+                        symb = '  '
+                    string.append(symb.rjust(5))
+                if not found:
+                    string[0] = '  X  '
+                rows.append('|'.join(string))
+            rows.append(' '.join('{}'.format(i).rjust(5) for i in range(fret_min, fret_max + 2)))
+            rows = self.put(key, tuple(rows))
+        return list(rows)
+
+    def clear(self):
+        super().clear()
+        self._grids.clear()
+
+    @property
+    def stats(self):
+        return dict(super().stats, grids=len(self._grids))
+
+
 class Fretboard:
 
+    diagrams = DiagramCache()
+
     def __init__(self, tuning=None, frets=22):
         self.frets = frets
         self.allow_bass = True
@@ -62,85 +246,90 @@ class Fretboard:
         start_note = self.tuning[n-1]
         return start_note + int(fret)
 
+    def matrix(self, frets=None, kapo=0):
+        if frets is None:
+            frets = self.frets
+        # numpy is loaded with the first matrix, not with this module
+        from fretboard import FretMatrix
+        return FretMatrix.get([n.pitch for n in self.tuning], frets, kapo)
+
     def find_chord_(self, chord, kapo=0, max_frets=3):
-        noteset = set()
-        chord_pos = list()
-        major_steps = [note.major for note in chord.steps.values()]
-        for k, n in enumerate(self.tuning):
-            n = n.major
-            nearest_notes = list()
-            for i in range(-24, 24, 12):
-                nearest_notes += [note + i - n for note in major_steps
-                                  if note + i - n >= 0]
-
-            for nearest_note in nearest_notes:
-                chord_pos.append((k + 1, nearest_note))
-                noteset.add(nearest_note)
-
-        return sorted(chord_pos), chord
+        pitches = [note.pitch for note in chord.steps.values()]
+        return self.matrix().octave_positions(pitches), chord
 
     @property
     def strings(self):
         return len(list(self.tuning))
 
-    def draw_chord(self, chord_data):
+    def voicings(self, chord, kapo=0, span=4, top=5):
+        """ top playable voicings of chord, best first (see fretboard.VoicingSearch)
+        """
+        steps = chord.steps
+        bass_step = min(steps)
+        bass = steps[bass_step].pitch % 12 if bass_step < 1 else None
+        return self.matrix(kapo=kapo).voicings(
+            {note.pitch % 12 for note in steps.values()},
+            {steps[step].pitch % 12 for step in chord.essential_steps()},
+            bass=bass, root=chord.tonic.pitch % 12, span=span, top=top,
+        )
+
+    def draw_voicing(self, voicing, chord):
+        frets = [fret for fret in voicing.frets if fret is not None]
+        return self.draw_chord((voicing.positions, chord), fret_max=max(max(frets), min(frets) + 3))
+
+    def draw_chord(self, chord_data, fret_max=11):
         inner_steps, chord = chord_data
         steps = inner_steps
         frets = [v for k, v in steps if v is not None]
         if not frets:
             return ['Failed to build']
 
-        fret_max = 11
         fret_min = min(frets)
+        return self.diagrams.chord(self.tuning, inner_steps, chord, fret_min, fret_max)
 
-        fretboard = list()
-        for n in range(self.strings, 0, -1):
-            string = list()
-            found = False
-            for i in range(fret_min, fret_max + 2):
-                if (n, i) in inner_steps:
-                    template = ' {} '
-                    current_note = self[n, i]
-                    if current_note.major.key == chord.tonic.major.key:
-                        template = '`{} '
-                    elif chord.steps.get(3) is not None and current_note.major.key == chord.steps[3].major.key:
-                        template = '³{} '
-                    elif chord.steps.get(7) is not None and current_note.major.key == chord.steps[7].major.key:
-                        template = '⁷{} '
-                    symb = template.format(n)
-                    found = True
-                else:
-                    symb = '  '
-                string.append('{}'.format(symb).rjust(5))
-            if not found:
-                string[0] = '  X  '
-            fretboard.append('|'.join(string))
-        string = list()
-        for i in range(fret_min, fret_max + 2):
-            string.append('{}'.format(i).rjust(5))
-        fretboard.append(' '.join(string))
-        return fretboard
+    def _note_positions(self, pitches, exact=False, frets=22, kapo=0):
+        """ per pitch: (string, fret) on every string, as find_note yields
+        """
+        matrix = self.matrix()
+        if exact:
+            intervals = matrix.intervals(pitches)
+            keep = (intervals >= kapo) & (intervals <= frets)
+            return [[(string + 1, fret) for string, (fret, ok) in enumerate(zip(row, row_keep)) if ok]
+                    for row, row_keep in zip(intervals.tolist(), keep.tolist())]
+        return [list(enumerate(row, 1)) for row in matrix.nearest_frets(pitches).tolist()]
 
     def find_note(self, note, exact=False, frets=22, kapo=0):
-        for string, n in enumerate(self.tuning):
-            i = 0
-            if exact:
-                if frets >= note - n >= kapo:
-                    yield string + 1, note - n
-            else:
-                while (n + i).name != note.name:
-                    i += 1
-                yield string + 1, i
+        for position in self._note_positions([note.pitch], exact=exact, frets=frets, kapo=kapo)[0]:
+            yield position
 
     def find_chord(self, chord, exact=False, frets=22, kapo=0):
-        applicature = dict()
-        for step, note in chord.steps.items():
-            positions = list()
-            for string, fret in self.find_note(note, exact=exact, frets=frets, kapo=kapo):
-                positions.append((string, fret))
-            applicature[step] = positions
+        steps = list(chord.steps.items())
+        positions = self._note_positions([note.pitch for step, note in steps],
+                                         exact=exact, frets=frets, kapo=kapo)
+        applicature = {step: step_positions for (step, note), step_positions in zip(steps, positions)}
         return applicature, chord.steps
 
+    def find_chords(self, chords, exact=False, frets=22, kapo=0):
+        """ find_chord for many chords, all notes in one vectorized query
+        """
+        steps = [list(chord.steps.items()) for chord in chords]
+        positions = iter(self._note_positions([note.pitch for chord_steps in steps for step, note in chord_steps],
+                                              exact=exact, frets=frets, kapo=kapo))
+        found = list()
+        for chord, chord_steps in zip(chords, steps):
+            applicature = {step: next(positions) for step, note in chord_steps}
+            found.append((applicature, chord.steps))
+        return found
+
+    def where(self, notes, kapo=0):
+        """ every (string, fret) sounding any of the notes' pitch classes
+        """
+        return self.matrix(kapo=kapo).where({note.pitch % 12 for note in notes})
+
+    def where_batch(self, chords, kapo=0):
+        return self.matrix(kapo=kapo).where_batch(
+            [{note.pitch % 12 for note in chord.steps.values()} for chord in chords])
+
     def draw_note(self, notes, start=0, end=None):
         if end is None:
             end = self.frets + 1
@@ -163,24 +352,10 @@ class Fretboard:
         print(' '.join(string))
 
     def get_schema(self, notes, start=0, end=11):
-        schema = list()
-        for n in reversed(list(self.tuning)):
-            string = list()
-            for i in range(start, end + 1):
-                if (n + i).major.key in notes:
-                    symb = (n + i).major
-                elif (n + i).minor.key in notes:
-                    symb = (n + i).minor
-                else:
-                    symb = '  '
-                string.append(' {}'.format(symb).rjust(4))
-            schema.append('|'.join(string))
-
-        string = list()
-        for i in range(start, end + 1):
-            string.append('{}'.format(i).rjust(4))
-        schema.append(' '.join(string))
-        return schema
+        """ rows of the fretboard from start to end fret, notes named in
+            `notes` shown (see DiagramCache)
+        """
+        return self.diagrams.schema(self.tuning, notes, start, end)
 
     def __getitem__(self, item):
         return self.note(*item)
@@ -213,13 +388,22 @@ class ChordBuilder:
     """
 
     NATURAL_MAJOR_STEPS = 'CDEFGAB'
+    DROPPABLE_STEPS = 5, 9, 11
+    # step -> semitones above the tonic in natural major (index 0 unused)
+    STEP_INTERVALS = [0]
+    for step in range(1, 29):
+        octave, degree = divmod(step - 1, 7)
+        STEP_INTERVALS.append(octave * 12 + Note.INDEXES[0][NATURAL_MAJOR_STEPS[degree]])
+    STEP_INTERVALS = tuple(STEP_INTERVALS)
+    del step, octave, degree
 
     def __init__(self, tonic: Note):
         assert isinstance(tonic, Note)
         self.steps = dict()
         self.steps[1] = tonic
         self.is_minor = False
-        print(' 1 {} tonic'.format(self.tonic))
+        if BuildTrace.enabled:
+            BuildTrace.emit('tonic', 1, tonic)
 
     @property
     def tonic(self):
@@ -227,32 +411,36 @@ class ChordBuilder:
 
     @classmethod
     def step_interval(cls, step):
+        if 0 < step < len(cls.STEP_INTERVALS):
+            return cls.STEP_INTERVALS[step]
         steps = cls.NATURAL_MAJOR_STEPS * (step // 7 + 1)
         octave = (step - 1) // 7
         interval = Note(steps[step - 1], octave=octave) - Note('C', octave=0)
         return interval
 
     def add_natural_major_step(self, step):
-        interval = self.step_interval(step)
-        self.steps[step] = self.tonic + interval
-        self.steps[step].set_gamma(self.tonic.gamma)
-        print(' {} {} added'.format(step, self.steps[step]))
+        # tonic + interval keeps the tonic's gamma
+        self.steps[step] = self.steps[1] + self.step_interval(step)
+        if BuildTrace.enabled:
+            BuildTrace.emit('added', step, self.steps[step])
 
     def enlarge(self, step):
         if self.steps.get(step) is None:
-            print('no step {} to enlarge'.format(step))
+            if BuildTrace.enabled:
+                BuildTrace.emit('missing', step, detail='enlarge')
             return
-        print('♯{} {} enlarged'.format(step, self.steps[step]))
-        self.steps[step] += 1
-        self.steps[step].set_gamma(Note.MAJOR)
+        if BuildTrace.enabled:
+            BuildTrace.emit('enlarged', step, self.steps[step])
+        self.steps[step] = Note.intern(self.steps[step].pitch + 1, Note.gamma_index(Note.MAJOR))
 
     def reduce(self, step):
         if self.steps.get(step) is None:
-            print('no step {} to reduce'.format(step))
+            if BuildTrace.enabled:
+                BuildTrace.emit('missing', step, detail='reduce')
             return
-        print('♭{} {} reduced'.format(step, self.steps[step]))
-        self.steps[step] -= 1
-        self.steps[step].set_gamma(Note.MINOR)
+        if BuildTrace.enabled:
+            BuildTrace.emit('reduced', step, self.steps[step])
+        self.steps[step] = Note.intern(self.steps[step].pitch - 1, Note.gamma_index(Note.MINOR))
 
     def expand_to(self, target_step, maj=False):
         for step in range(3, target_step+1, 2):
@@ -293,7 +481,8 @@ class ChordBuilder:
             r"sus[249]"
             as last
         """
-        print(' {} {} suspended to {}'.format(base,  self.steps[base], target))
+        if BuildTrace.enabled:
+            BuildTrace.emit('suspended', base, self.steps.get(base), target)
         if base in self.steps:
             del self.steps[base]
 
@@ -329,14 +518,45 @@ class ChordBuilder:
         self.steps[i] = Note(key, octave=self.tonic.octave-1)
 
     def omit(self, step):
-        print(' {} {} omitted'.format(step, self.steps[step]))
         if self.steps.get(step) is not None:
+            if BuildTrace.enabled:
+                BuildTrace.emit('omitted', step, self.steps[step])
             del self.steps[step]
 
     def next(self, step):
         next_note = self.tonic + self.step_interval(step)
         return ChordBuilder(next_note)
 
+    def compile(self):
+        """ immutable snapshot: (step, note) pairs in build order
+        """
+        return CompiledChord(tuple(self.steps.items()), self.is_minor)
+
+    @classmethod
+    def from_compiled(cls, compiled):
+        """ fresh builder over a compiled chord, without rebuilding it
+        """
+        chord = cls.__new__(cls)
+        chord.steps = dict(compiled.steps)
+        chord.is_minor = compiled.is_minor
+        return chord
+
+    def essential_steps(self):
+        """ steps a voicing must keep: first, last, third, seventh, others;
+            an unaltered 5, 9 or 11 can be dropped unless it is the last
+        """
+        last = max(self.steps)
+        essential = list()
+        for step, note in self.steps.items():
+            if step < 1:
+                continue
+            if step in self.DROPPABLE_STEPS and step != last:
+                interval = (note.pitch - self.tonic.pitch) % 12
+                if interval == self.step_interval(step) % 12:
+                    continue
+            essential.append(step)
+        return essential
+
     @property
     def notes(self):
         return self.steps
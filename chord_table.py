@@ -0,0 +1,171 @@
+import os
+import struct
+import sys
+from array import array
+from chord import ChordBuilder, CompiledChord
+from note import Note
+from parser import ChordParser, corpus
+
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chord_table.bin')
+
+TONICS = tuple(dict.fromkeys(Note.NAMES[0] + Note.NAMES[1]))
+QUALITIES = '', 'm'
+EXTENSIONS = '', '5', '6', '7', '9', '11', '13', '6/9', 'maj7', 'maj9', 'maj11', 'maj13', 'add9', 'add11', 'add13'
+ALTERATIONS = '', 'b5', '#5', 'b9', '#9', '#11', 'b13', 'sus2', 'sus4', 'no3', 'no5'
+MODIFIERS = 'dim', 'dim7', 'aug', '+', 'sus', 'sus2', 'sus4', '7sus4', '9sus4', '13sus4'
+
+
+def vocabulary():
+    """ every supported symbol: all tonics with the corpus suffixes and
+        quality x extension x alteration combinations, normalized
+    """
+    suffixes = dict()
+    for symbol in corpus():
+        try:
+            tonic = ChordParser.parse(symbol).tonic
+        except ValueError:
+            continue
+        suffixes[ChordParser.normalize(symbol)[len(tonic):]] = None
+    for quality in QUALITIES:
+        for extension in EXTENSIONS:
+            for alteration in ALTERATIONS:
+                suffixes[quality + extension + alteration] = None
+    for modifier in MODIFIERS:
+        suffixes[modifier] = None
+
+    symbols = dict()
+    for tonic in TONICS:
+        for suffix in suffixes:
+            symbols[ChordParser.normalize(tonic + suffix)] = None
+    return list(symbols)
+
+
+class ChordTable:
+    """ Precomputed symbol -> CompiledChord table
+
+        File layout (little endian):
+            b'CHT1', uint32 count, uint32 symbols size,
+            symbols (utf-8, newline separated), uint32 offsets[count],
+            records: uint8 is_minor, uint8 steps, steps x (int8 step, int16 pitch, uint8 gamma)
+
+        Only the symbol index is built on load; records are decoded on
+        first lookup. Symbols are looked up normalized (ChordParser.normalize),
+        a trailing "/bass" is added to the tabled chord.
+    """
+
+    MAGIC = b'CHT1'
+    HEADER = struct.Struct('<4sII')
+    RECORD = struct.Struct('<BB')
+    STEP = struct.Struct('<bhB')
+
+    def __init__(self, data=b'', index=None, records=0):
+        self._data = data
+        self._index = index if index is not None else dict()
+        self._records = records
+        self._decoded = dict()
+
+    @classmethod
+    def build(cls, symbols=None):
+        if symbols is None:
+            symbols = vocabulary()
+        compiled = dict()
+        for symbol in symbols:
+            try:
+                compiled[symbol] = ChordParser.compile(symbol)
+            except ValueError:
+                continue
+        return cls.from_compiled(compiled)
+
+    @classmethod
+    def from_compiled(cls, compiled):
+        records = bytearray()
+        offsets = array('I')
+        for chord in compiled.values():
+            offsets.append(len(records))
+            records += cls.RECORD.pack(chord.is_minor, len(chord.steps))
+            for step, note in chord.steps:
+                records += cls.STEP.pack(step, note.pitch, Note.gamma_index(note.gamma))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        symbols = '\n'.join(compiled).encode('utf-8')
+        data = b''.join((
+            cls.HEADER.pack(cls.MAGIC, len(compiled), len(symbols)),
+            symbols,
+            offsets.tobytes(),
+            records,
+        ))
+        return cls.from_bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, count, symbols_size = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError('Not a chord table')
+        start = cls.HEADER.size
+        symbols = bytes(data[start:start + symbols_size]).decode('utf-8').split('\n') if count else []
+        start += symbols_size
+        offsets = array('I')
+        offsets.frombytes(data[start:start + count * offsets.itemsize])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return cls(data, dict(zip(symbols, offsets)), start + count * offsets.itemsize)
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        """ load a table written by dump(); empty table if there is none
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    def dump(self, path=DEFAULT_PATH):
+        with open(path, 'wb') as f:
+            f.write(self._data)
+
+    def compiled(self, symbol):
+        compiled = self._decoded.get(symbol)
+        if compiled is None:
+            offset = self._index.get(symbol)
+            if offset is None:
+                return None
+            offset += self._records
+            is_minor, count = self.RECORD.unpack_from(self._data, offset)
+            offset += self.RECORD.size
+            steps = list()
+            for step, pitch, gamma_index in self.STEP.iter_unpack(
+                    self._data[offset:offset + count * self.STEP.size]):
+                steps.append((step, Note.intern(pitch, gamma_index)))
+            compiled = CompiledChord(tuple(steps), bool(is_minor))
+            self._decoded[symbol] = compiled
+        return compiled
+
+    def get(self, symbol):
+        """ fresh ChordBuilder for a normalized symbol, None if not tabled
+        """
+        compiled = self.compiled(symbol)
+        if compiled is not None:
+            return ChordBuilder.from_compiled(compiled)
+        base, slash, bass = symbol.rpartition('/')
+        # "X+/B" is not "X+" with a bass: the "+" is only aug at the very end
+        if slash and not base.endswith('+') and (bass in Note.INDEXES[0] or bass in Note.INDEXES[1]):
+            compiled = self.compiled(base)
+            if compiled is not None:
+                chord = ChordBuilder.from_compiled(compiled)
+                chord.add_bass(bass)
+                return chord
+        return None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, symbol):
+        return symbol in self._index
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH
+    table = ChordTable.build()
+    table.dump(path)
+    print('{} chords, {} bytes -> {}'.format(len(table), len(table._data), path))
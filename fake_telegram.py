@@ -0,0 +1,286 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import socket
+import sys
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+
+
+class FakeTelegram:
+    """ Minimal local Bot API server for load tests
+
+        Serves getUpdates (long polling) from updates queued with push()
+        or, once setWebhook was called, posts them to the webhook like
+        Telegram does: in order per chat, over at most max_connections
+        keep-alive connections. Every other method gets a plausible
+        result. Records when each chat gets its reply: latency is from
+        push(track=True) to the next sendDocument or sendMessage to that
+        chat. `delay` seconds of one-way network delay are added to every
+        request, response and webhook delivery.
+    """
+
+    BOT = dict(id=1, is_bot=True, first_name='Chord Bot', username='fake_chord_bot')
+    MULTIPART_FIELD = re.compile(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n')
+
+    def __init__(self, host='127.0.0.1', port=0, poll_wait=1, max_connections=40, delay=0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.poll_wait = poll_wait
+        self.max_connections = max_connections
+        self.webhook = None
+        self.secret_token = None
+        self.updates = list()
+        self.update_id = 0
+        self.message_id = 0
+        self.requests = 0
+        self.uploads = 0
+        self.latencies = list()
+        self._sent = dict()
+        self._new_updates = None
+        self._replies = None
+        self._server = None
+        self._client = None
+        self._connections = None
+        # chat id -> its last webhook delivery, the next one waits for it
+        self._deliveries = dict()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/bot'.format(self.host, self.port)
+
+    async def start(self):
+        self._new_updates = asyncio.Event()
+        self._replies = asyncio.Condition()
+        self._connections = asyncio.Semaphore(self.max_connections)
+        self._client = httpx.AsyncClient(limits=httpx.Limits(max_connections=self.max_connections))
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self._client.aclose()
+
+    def push(self, user_id, text, track=False):
+        """ queue a private text message from user_id
+        """
+        self.update_id += 1
+        message = dict(
+            message_id=self.update_id,
+            date=int(time.time()),
+            chat=dict(id=user_id, type='private'),
+            text=text,
+            **{'from': dict(id=user_id, is_bot=False, first_name='user{}'.format(user_id))}
+        )
+        if text.startswith('/'):
+            message['entities'] = [dict(type='bot_command', offset=0, length=len(text.split()[0]))]
+        update = dict(update_id=self.update_id, message=message)
+        if track:
+            self._sent[user_id] = time.perf_counter()
+        if self.webhook is None:
+            self.updates.append(update)
+            self._new_updates.set()
+            return
+        delivery = asyncio.ensure_future(self._deliver(update, self._deliveries.get(user_id)))
+        self._deliveries[user_id] = delivery
+        delivery.add_done_callback(
+            lambda task: self._deliveries.pop(user_id) if self._deliveries.get(user_id) is task else None)
+
+    async def _deliver(self, update, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        headers = dict()
+        if self.secret_token:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = self.secret_token
+        async with self._connections:
+            response = await self._client.post(self.webhook, json=update, headers=headers)
+        response.raise_for_status()
+
+    async def wait_replies(self, count, timeout=None):
+        """ wait until `count` tracked messages got their reply
+        """
+        async with self._replies:
+            await asyncio.wait_for(self._replies.wait_for(lambda: len(self.latencies) >= count), timeout)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method = request_line.split()[1].decode().rsplit('/', 1)[-1]
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                result = await self._call(method, self._params(headers.get('content-type', ''), body))
+                payload = json.dumps(dict(ok=True, result=result)).encode()
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _params(self, content_type, body):
+        if content_type.startswith('multipart/form-data'):
+            params = {name.decode(): value.decode('utf-8', 'replace')
+                      for name, value in self.MULTIPART_FIELD.findall(body)}
+            params['upload'] = True
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return dict(parse_qsl(body.decode('utf-8')))
+
+    async def _call(self, method, params):
+        self.requests += 1
+        if method == 'getMe':
+            return self.BOT
+        if method == 'getUpdates':
+            return await self._get_updates(int(params.get('offset', 0) or 0), float(params.get('timeout', 0) or 0))
+        if method in ('sendDocument', 'sendMessage'):
+            return await self._reply(method, params)
+        if method == 'setWebhook':
+            self.webhook = params['url']
+            self.secret_token = params.get('secret_token')
+        elif method == 'deleteWebhook':
+            self.webhook = None
+        return True
+
+    async def _get_updates(self, offset, timeout):
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(timeout, self.poll_wait))
+            except asyncio.TimeoutError:
+                pass
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        return self.updates[:100]
+
+    async def _reply(self, method, params):
+        chat_id = int(params['chat_id'])
+        self.message_id += 1
+        message = dict(message_id=self.message_id, date=int(time.time()),
+                       chat=dict(id=chat_id, type='private'), from_=self.BOT)
+        message['from'] = message.pop('from_')
+        if method == 'sendDocument':
+            if params.get('upload'):
+                self.uploads += 1
+            message['document'] = dict(file_id='file{}'.format(self.message_id),
+                                       file_unique_id='unique{}'.format(self.message_id))
+        else:
+            message['text'] = params.get('text', '')
+        sent = self._sent.pop(chat_id, None)
+        if sent is not None:
+            async with self._replies:
+                self.latencies.append(time.perf_counter() - sent)
+                self._replies.notify_all()
+        return message
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def melodies(count, seed=0, length=(16, 256)):
+    """ random melody strings in the bot's help-text style
+    """
+    rng = random.Random(seed)
+    return [rng.choice('123') + ''.join(rng.choice('123.-_') for _ in range(rng.randint(*length) - 1))
+            for _ in range(count)]
+
+
+def free_port(host='127.0.0.1'):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+async def burst(users=2000, concurrency=64, workers=None, mode='thread', pending=None, distinct=True,
+                webhook=False, rate=None, delay=0):
+    """ every user sets a chordset and sends a melody through a
+        FakeTelegram, all at once or `rate` users per second: reply
+        latencies in seconds, wall time and stats. mode is 'thread' or
+        'process' (a RenderPool) or 'workers' (a WorkerPool); updates come
+        by long polling or, with webhook, to the bot's webhook server, with
+        `delay` seconds of simulated one-way network delay
+    """
+    from bot import ChordBot, build_application
+    from midi_cache import MidiCache
+    from render_pool import RenderPool
+    from session_store import SessionStore
+    from workers import WorkerPool
+
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    server = FakeTelegram(delay=delay)
+    await server.start()
+    ChordBot.sessions = SessionStore()
+    ChordBot.midi_cache = MidiCache()
+    if mode == 'workers':
+        ChordBot.pool = WorkerPool(workers=workers, pending=pending)
+        ChordBot.pool.wait_workers()
+    else:
+        ChordBot.pool = RenderPool(workers=workers, processes=mode == 'process', pending=pending)
+    application = build_application('1:fake', base_url=server.url, concurrency=concurrency)
+    songs = melodies(users if distinct else 1)
+    async with application:
+        await application.start()
+        if webhook:
+            port = free_port()
+            await application.updater.start_webhook(
+                listen='127.0.0.1', port=port, url_path='hook', secret_token='secret',
+                webhook_url='http://127.0.0.1:{}/hook'.format(port))
+        else:
+            await application.updater.start_polling(poll_interval=0, timeout=1)
+        start = time.perf_counter()
+        for user_id in range(1, users + 1):
+            if rate:
+                await asyncio.sleep(max(0, start + (user_id - 1) / rate - time.perf_counter()))
+            server.push(user_id, '/chords Am Dm E')
+            server.push(user_id, songs[(user_id - 1) % len(songs)], track=True)
+        await server.wait_replies(users)
+        wall = time.perf_counter() - start
+        await application.updater.stop()
+        await application.stop()
+    await server.stop()
+    ChordBot.pool.shutdown()
+    return server.latencies, wall, dict(pool=ChordBot.pool.stats, uploads=server.uploads, requests=server.requests)
+
+
+def report(latencies, wall, stats):
+    return 'p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms, {:.0f} replies/s, {}'.format(
+        percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3,
+        max(latencies) * 1e3, len(latencies) / wall, stats)
+
+
+if __name__ == '__main__':
+    # python fake_telegram.py [users] [workers] [thread|process|workers] [polling|webhook|compare]
+    #                         [users per second] [one-way delay ms]
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'thread'
+    updates = sys.argv[4] if len(sys.argv) > 4 else 'polling'
+    rate = float(sys.argv[5]) if len(sys.argv) > 5 else None
+    delay = float(sys.argv[6]) / 1000 if len(sys.argv) > 6 else 0
+    for webhook in {'polling': [False], 'webhook': [True], 'compare': [False, True]}[updates]:
+        result = asyncio.run(burst(users, workers=workers, mode=mode, webhook=webhook, rate=rate, delay=delay))
+        print('webhook' if webhook else 'polling', report(*result))
@@ -0,0 +1,252 @@
+import heapq
+from collections import namedtuple
+
+import numpy as np
+
+
+class FretMatrix:
+    """ strings x frets pitch matrix of a tuning
+
+        pitches[s, f] is the absolute pitch (Note.pitch) of fret f on string
+        s + 1, classes[s, f] its pitch class. Queries are answered with
+        vectorized masks over the whole matrix; positions are (string, fret)
+        with strings numbered from 1, as Fretboard uses them.
+        Matrices are shared per (open pitches, frets, kapo) via get().
+    """
+
+    OCTAVES = np.arange(-24, 24, 12)
+
+    _matrices = dict()
+
+    def __init__(self, open_pitches, frets=22, kapo=0):
+        self.open = np.array(open_pitches, dtype=np.int64)
+        self.frets = frets
+        self.kapo = kapo
+        self.pitches = self.open[:, None] + np.arange(frets + 1)
+        self.classes = self.pitches % 12
+        self.playable = np.arange(frets + 1) >= kapo
+        for array in (self.open, self.pitches, self.classes, self.playable):
+            array.flags.writeable = False
+        self._voicings = dict()
+
+    @classmethod
+    def get(cls, open_pitches, frets=22, kapo=0):
+        key = tuple(open_pitches), frets, kapo
+        matrix = cls._matrices.get(key)
+        if matrix is None:
+            matrix = cls._matrices[key] = cls(*key)
+        return matrix
+
+    @property
+    def strings(self):
+        return len(self.open)
+
+    def mask(self, pitch_classes):
+        """ strings x frets mask of playable frets sounding any of pitch_classes
+        """
+        table = np.zeros(12, dtype=bool)
+        table[np.asarray(list(pitch_classes), dtype=np.int64) % 12] = True
+        return table[self.classes] & self.playable
+
+    def masks(self, pitch_class_sets):
+        """ chords x strings x frets masks for many pitch class sets at once
+        """
+        table = np.zeros((len(pitch_class_sets), 12), dtype=bool)
+        for i, pitch_classes in enumerate(pitch_class_sets):
+            table[i, np.asarray(list(pitch_classes), dtype=np.int64) % 12] = True
+        return table[:, self.classes] & self.playable
+
+    def where(self, pitch_classes):
+        strings, frets = np.nonzero(self.mask(pitch_classes))
+        return list(zip((strings + 1).tolist(), frets.tolist()))
+
+    def where_batch(self, pitch_class_sets):
+        chords, strings, frets = np.nonzero(self.masks(pitch_class_sets))
+        bounds = np.searchsorted(chords, np.arange(len(pitch_class_sets) + 1))
+        strings = (strings + 1).tolist()
+        frets = frets.tolist()
+        return [list(zip(strings[start:end], frets[start:end]))
+                for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+    def voicings(self, pitch_classes, required=(), bass=None, root=None, span=4, top=5):
+        """ top playable voicings (see VoicingSearch), memoized
+        """
+        key = frozenset(pitch_classes), frozenset(required), bass, root, span, top
+        voicings = self._voicings.get(key)
+        if voicings is None:
+            search = VoicingSearch(self, pitch_classes, required, bass=bass, root=root, span=span, top=top)
+            voicings = self._voicings[key] = tuple(search.run())
+        return voicings
+
+    def intervals(self, pitches):
+        """ notes x strings: semitones from each open string to each pitch
+        """
+        return np.asarray(pitches, dtype=np.int64)[:, None] - self.open
+
+    def nearest_frets(self, pitches):
+        """ notes x strings: lowest fret of each pitch class on each string
+        """
+        return self.intervals(pitches) % 12
+
+    def octave_positions(self, pitches):
+        """ sorted (string, fret) of every pitch shifted by -2..+1 octaves,
+            wherever the fret is not negative
+        """
+        frets = (np.asarray(pitches, dtype=np.int64)[None, None, :]
+                 + self.OCTAVES[None, :, None] - self.open[:, None, None])
+        strings = np.broadcast_to(np.arange(1, self.strings + 1)[:, None, None], frets.shape)
+        keep = frets >= 0
+        strings = strings[keep]
+        frets = frets[keep]
+        order = np.lexsort((frets, strings))
+        return list(zip(strings[order].tolist(), frets[order].tolist()))
+
+
+class Voicing(namedtuple('Voicing', 'frets cost')):
+    """ one fret (or None for a muted string) per string, in tuning order
+    """
+
+    @property
+    def positions(self):
+        return [(string, fret) for string, fret in enumerate(self.frets, 1) if fret is not None]
+
+
+class VoicingSearch:
+    """ Branch-and-bound search of playable voicings on a FretMatrix
+
+        A voicing plays at most one fret per string. Fretted notes lie in a
+        window of `span` frets starting at the lowest fretted note (open
+        strings are free), use at most `fingers` fingers (the lowest fret
+        may be barred), sound every required pitch class and, if `bass` is
+        set, have it as the lowest note. Cost (lower is more playable):
+        stretch, fingers, muted strings, muted strings between played
+        ones, position on the neck, a non-root bass and missing optional
+        tones. Strings are walked from the lowest; a branch is cut as soon
+        as the required tones can't fit the strings left, the bass is
+        settled wrong, or its cost reaches the current top-k worst.
+    """
+
+    STRETCH = 0.5
+    FINGER = 0.5
+    MUTE = 1
+    GAP = 3
+    POSITION = 0.5
+    NOT_ROOT_BASS = 4
+    MISSING = 1
+
+    def __init__(self, matrix, pitch_classes, required=(), bass=None, root=None, span=4, top=5, fingers=4):
+        self.matrix = matrix
+        self.chord_mask = self.bits(pitch_classes)
+        self.required_mask = self.bits(required) | (self.bits([bass]) if bass is not None else 0)
+        self.required_count = bin(self.required_mask).count('1')
+        self.bass = bass
+        self.root = root
+        self.span = span
+        self.top = top
+        self.fingers = fingers
+        # max-heap of the best voicings so far: (-cost, frets), -1 is muted
+        self.found = list()
+        # lowest string first
+        self.order = list(range(matrix.strings - 1, -1, -1))
+        opens = matrix.open.tolist()
+        self.lowest_left = [min(opens[s] for s in self.order[i:]) + matrix.kapo
+                            for i in range(len(self.order))]
+        self.pitches = matrix.pitches.tolist()
+        self.classes = matrix.classes.tolist()
+
+    @staticmethod
+    def bits(pitch_classes):
+        mask = 0
+        for pitch_class in pitch_classes:
+            mask |= 1 << (pitch_class % 12)
+        return mask
+
+    def threshold(self):
+        if len(self.found) < self.top:
+            return float('inf')
+        return -self.found[0][0]
+
+    def run(self):
+        kapo = self.matrix.kapo
+        self.search_window(None, (kapo,))
+        for start in range(kapo + 1, self.matrix.frets + 1):
+            frets = (kapo,) + tuple(range(start, min(start + self.span, self.matrix.frets + 1)))
+            self.search_window(start, frets)
+        ranked = sorted((-negative_cost, frets) for negative_cost, frets in self.found)
+        return [Voicing(self.unkey(frets), cost) for cost, frets in ranked]
+
+    @staticmethod
+    def unkey(frets):
+        return tuple(None if fret < 0 else fret for fret in frets)
+
+    def search_window(self, start, frets):
+        kapo = self.matrix.kapo
+        options = list()
+        for string in self.order:
+            classes = self.classes[string]
+            pitches = self.pitches[string]
+            options.append([(fret, pitches[fret], classes[fret]) for fret in frets
+                            if self.chord_mask >> classes[fret] & 1])
+        base_cost = self.POSITION * (start - kapo) if start is not None else 0
+        played = [-1] * self.matrix.strings
+        strings = len(self.order)
+
+        def walk(i, covered, cost, lowest, lowest_class, fixed, started, gap, fingers, barre, count):
+            if cost >= self.threshold():
+                return
+            if self.required_count - bin(covered & self.required_mask).count('1') > strings - i:
+                return
+            # the bass is settled once no string left can sound lower
+            if not fixed and lowest is not None and (i == strings or lowest <= self.lowest_left[i]):
+                fixed = True
+                if self.bass is not None:
+                    if lowest_class != self.bass:
+                        return
+                elif self.root is not None and lowest_class != self.root:
+                    cost += self.NOT_ROOT_BASS
+                    if cost >= self.threshold():
+                        return
+            if i == strings:
+                if start is not None and not barre:
+                    return
+                if covered & self.required_mask != self.required_mask or count < max(2, self.required_count):
+                    return
+                missing = bin(self.chord_mask & ~covered).count('1')
+                cost += self.MISSING * missing
+                if cost >= self.threshold():
+                    return
+                entry = -cost, tuple(played)
+                if len(self.found) < self.top:
+                    heapq.heappush(self.found, entry)
+                else:
+                    heapq.heapreplace(self.found, entry)
+                return
+            string = self.order[i]
+            for fret, pitch, pitch_class in options[i]:
+                add = self.GAP if gap else 0
+                string_fingers = fingers
+                string_barre = barre
+                if fret != kapo:
+                    add += self.STRETCH * (fret - start)
+                    if fret == start:
+                        if not barre:
+                            string_fingers += 1
+                            add += self.FINGER
+                        string_barre = True
+                    else:
+                        string_fingers += 1
+                        add += self.FINGER
+                    if string_fingers > self.fingers:
+                        continue
+                played[string] = fret
+                if lowest is None or pitch < lowest:
+                    walk(i + 1, covered | 1 << pitch_class, cost + add, pitch, pitch_class, fixed,
+                         True, False, string_fingers, string_barre, count + 1)
+                else:
+                    walk(i + 1, covered | 1 << pitch_class, cost + add, lowest, lowest_class, fixed,
+                         True, False, string_fingers, string_barre, count + 1)
+            played[string] = -1
+            walk(i + 1, covered, cost + self.MUTE, lowest, lowest_class, fixed, started, gap or started,
+                 fingers, barre, count)
+
+        walk(0, 0, base_cost, None, None, False, False, False, 0, False, 0)
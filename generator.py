@@ -1,55 +1,636 @@
+import logging
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from bisect import bisect_left
+from fractions import Fraction
+from heapq import heappop, heappush
+from lru import LRUCache
+from melody import Clock, Melody
+from metrics import Metrics
+from midi_cache import MidiCache
 from parser import ChordParser
-from midiutil.MidiFile import MIDIFile
 from io import BytesIO
 
+logger = logging.getLogger(__name__)
+
+
+class MidiEncoder:
+    """ Standard MIDI file encoder for notes
+
+        Writes format 1 (a tempo track, then a track per notes list) or
+        format 0 (tempo and notes in one track), with the event order
+        MIDIUtil's MIDIFile uses: by tick, note offs before note ons, then
+        insertion order; duplicate events dropped and overlapping notes of
+        the same pitch cut where the next one starts. Notes are
+        (tick, duration, pitch, channel, velocity) in ticks; tempos are the
+        (tick, tempo) of tempo changes after the first tempo.
+    """
+
+    TICKS_PER_QUARTER = 960
+    NOTE_OFF = 0x80
+    NOTE_ON = 0x90
+    END_OF_TRACK = b'\x00\xff\x2f\x00'
+    # longest delta (4 bytes) plus status, pitch and velocity
+    MAX_EVENT_SIZE = 7
+    # largest delta time that fits those 4 bytes
+    MAX_DELTA = 0x0fffffff
+    # deltas below this (2 bytes) are memoized, ticks come from user input
+    CACHED_DELTAS = 1 << 14
+
+    _headers = dict()
+    _tempo_events = dict()
+    _deltas = dict()
+    _events = dict()
+
+    def __init__(self, tempo=120, file_format=1, ticks_per_quarter=TICKS_PER_QUARTER, tempos=()):
+        self.tempo = tempo
+        self.file_format = file_format
+        self.ticks_per_quarter = ticks_per_quarter
+        self.tempos = tuple(tempos)
+
+    def header(self, tracks):
+        key = self.file_format, tracks, self.ticks_per_quarter
+        header = self._headers.get(key)
+        if header is None:
+            header = self._headers[key] = b'MThd' + struct.pack('>LHHH', 6, *key)
+        return header
+
+    def tempo_event(self, tempo=None):
+        """ delta 0 set-tempo meta event
+        """
+        if tempo is None:
+            tempo = self.tempo
+        event = self._tempo_events.get(tempo)
+        if event is None:
+            event = self._tempo_events[tempo] = (
+                b'\x00\xff\x51\x03' + struct.pack('>L', int(60000000 / tempo))[1:])
+        return event
+
+    def tempo_changes(self):
+        """ (tick, set-tempo meta event without its delta) of every change
+        """
+        return [(tick, self.tempo_event(tempo)[1:]) for tick, tempo in self.tempos]
+
+    @classmethod
+    def delta(cls, ticks):
+        """ ticks as a variable length quantity
+        """
+        data = cls._deltas.get(ticks)
+        if data is None:
+            if ticks < 0:
+                raise ValueError('Negative delta time {}'.format(ticks))
+            if ticks > cls.MAX_DELTA:
+                raise ValueError('Delta time {} is longer than MIDI allows'.format(ticks))
+            chunks = [ticks & 0x7f]
+            rest = ticks >> 7
+            while rest:
+                chunks.append(rest & 0x7f | 0x80)
+                rest >>= 7
+            data = bytes(reversed(chunks))
+            if ticks < cls.CACHED_DELTAS:
+                cls._deltas[ticks] = data
+        return data
+
+    @classmethod
+    def event(cls, status, pitch, velocity):
+        key = status, pitch, velocity
+        data = cls._events.get(key)
+        if data is None:
+            # data bytes are 7 bit, anything else corrupts the file
+            if not 0 <= pitch <= 127:
+                raise ValueError('Note {} is outside the MIDI range 0..127'.format(pitch))
+            if not 0 <= velocity <= 127:
+                raise ValueError('Velocity {} is outside the MIDI range 0..127'.format(velocity))
+            data = cls._events[key] = bytes(key)
+        return data
+
+    @classmethod
+    def events(cls, notes):
+        """ sorted (tick, off/on, order, status, pitch, velocity) events
+        """
+        events = list()
+        for order, (tick, duration, pitch, channel, velocity) in enumerate(notes):
+            events.append((tick, 1, order, cls.NOTE_ON | channel, pitch, velocity))
+            events.append((tick + duration, 0, order, cls.NOTE_OFF | channel, pitch, velocity))
+        # already in order for a melody, where timsort is a single pass
+        events.sort()
+
+        unique = list()
+        seen = set()
+        tick = None
+        sounding = dict()
+        cut = False
+        for event in events:
+            if event[0] != tick:
+                tick = event[0]
+                seen.clear()
+            key = event[1], event[3] & 0x0f, event[4]
+            if key in seen:
+                continue
+            seen.add(key)
+            # an off while the pitch sounds twice ends at the later on
+            starts = sounding.setdefault(key[1:], list())
+            if event[1]:
+                starts.append(event[0])
+            elif len(starts) > 1:
+                event = (starts.pop(),) + event[1:]
+                cut = True
+            elif starts:
+                starts.pop()
+            unique.append(event)
+        if cut:
+            unique.sort()
+        return unique
+
+    def track(self, notes, prefix=b'', meta=()):
+        """ MTrk chunk: prefix events at tick 0, then the notes and the
+            (tick, event) of meta, each before the notes of its tick
+        """
+        events = self.events(notes)
+        meta_size = sum(len(event) + 4 for tick, event in meta)
+        data = bytearray(len(prefix) + len(events) * self.MAX_EVENT_SIZE + meta_size + len(self.END_OF_TRACK))
+        view = memoryview(data)
+        view[:len(prefix)] = prefix
+        position = len(prefix)
+        previous = 0
+        if meta:
+            start = 0
+            for meta_tick, event in meta:
+                end = bisect_left(events, (meta_tick,), start)
+                position, previous = self._write(view, position, previous, events[start:end])
+                chunk = self.delta(meta_tick - previous) + event
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+                previous = meta_tick
+                start = end
+            events = events[start:]
+        position, previous = self._write(view, position, previous, events)
+        view[position:position + 4] = self.END_OF_TRACK
+        position += 4
+        return b'MTrk' + struct.pack('>L', position) + view[:position].tobytes()
+
+    def _write(self, view, position, previous, events):
+        delta = self.delta
+        event_bytes = self.event
+        for tick, is_on, order, status, pitch, velocity in events:
+            chunk = delta(tick - previous) + event_bytes(status, pitch, velocity)
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+            previous = tick
+        return position, previous
+
+    def encode(self, tracks, prefixes=None):
+        """ the whole file for a list of note lists, one per track, each
+            with its prefix events if given
+        """
+        if prefixes is None:
+            prefixes = [b''] * len(tracks)
+        if self.file_format == 0:
+            notes = [note for track in tracks for note in track]
+            return self.header(1) + self.track(notes, self.tempo_event() + b''.join(prefixes), self.tempo_changes())
+        chunks = [self.header(len(tracks) + 1), self.track((), self.tempo_event(), self.tempo_changes())]
+        for notes, prefix in zip(tracks, prefixes):
+            chunks.append(self.track(notes, prefix))
+        return b''.join(chunks)
+
+    @classmethod
+    def iter_events(cls, notes):
+        """ lazy events() of notes given in start order
+
+            Events are held back only while an overlapping note of the same
+            pitch could still cut a note off back to their tick, so memory
+            follows the overlap, not the length of the melody.
+        """
+        ready = list()
+        seen = set()
+        tick = None
+        sounding = dict()
+        for event in cls._timeline(notes):
+            if event[0] != tick:
+                tick = event[0]
+                seen.clear()
+                # an off is cut back to at most the second start of its pitch
+                bound = min([starts[1] for starts in sounding.values() if len(starts) > 1], default=tick)
+                while ready and ready[0][0] < bound:
+                    yield heappop(ready)
+            key = event[1], event[3] & 0x0f, event[4]
+            if key in seen:
+                continue
+            seen.add(key)
+            starts = sounding.setdefault(key[1:], list())
+            if event[1]:
+                starts.append(event[0])
+            elif len(starts) > 1:
+                event = (starts.pop(),) + event[1:]
+            elif starts:
+                starts.pop()
+            if not starts:
+                del sounding[key[1:]]
+            heappush(ready, event)
+        while ready:
+            yield heappop(ready)
+
+    @classmethod
+    def _timeline(cls, notes):
+        """ (tick, off/on, order, status, pitch, velocity) events sorted as
+            in events(), keeping only the offs of notes still sounding
+        """
+        offs = list()
+        # note ons of the current tick, they follow the offs due by then
+        starts = list()
+        tick = None
+        for order, (start, duration, pitch, channel, velocity) in enumerate(notes):
+            if start != tick:
+                yield from cls._due(offs, starts, tick)
+                tick = start
+            starts.append((start, 1, order, cls.NOTE_ON | channel, pitch, velocity))
+            heappush(offs, (start + duration, 0, order, cls.NOTE_OFF | channel, pitch, velocity))
+        yield from cls._due(offs, starts, tick)
+        while offs:
+            yield heappop(offs)
+
+    @staticmethod
+    def _due(offs, starts, tick):
+        if tick is None:
+            return
+        while offs and offs[0][0] <= tick:
+            yield heappop(offs)
+        yield from starts
+        starts.clear()
+
+    def stream(self, notes, sink, chunk_size=1 << 16):
+        """ write a format 1 file with one notes track to sink, in chunks
+
+            notes are consumed lazily (see iter_events) and at most about
+            chunk_size bytes are buffered. The track length is patched in at
+            the end, so a sink that can't seek gets the file through a
+            spooled temporary file. Returns the number of bytes written.
+        """
+        if not (hasattr(sink, 'seekable') and sink.seekable()):
+            with tempfile.SpooledTemporaryFile(max_size=chunk_size) as spool:
+                size = self.stream(notes, spool, chunk_size)
+                spool.seek(0)
+                shutil.copyfileobj(spool, sink, chunk_size)
+            return size
+
+        head = self.header(2) + self.track((), self.tempo_event(), self.tempo_changes())
+        sink.write(head)
+        length_at = sink.tell() + 4
+        sink.write(b'MTrk\0\0\0\0')
+
+        delta = self.delta
+        event_bytes = self.event
+        buffer = bytearray()
+        length = 0
+        previous = 0
+        for tick, is_on, order, status, pitch, velocity in self.iter_events(notes):
+            buffer += delta(tick - previous)
+            buffer += event_bytes(status, pitch, velocity)
+            previous = tick
+            if len(buffer) >= chunk_size:
+                sink.write(buffer)
+                length += len(buffer)
+                buffer.clear()
+        buffer += self.END_OF_TRACK
+        sink.write(buffer)
+        length += len(buffer)
+
+        end = sink.tell()
+        sink.seek(length_at)
+        sink.write(struct.pack('>L', length))
+        sink.seek(end)
+        return len(head) + 8 + length
+
+
+class MelodyProgram:
+    """ Compiled melody: the start beat, length in beats and chord index of
+        every chord played, as parallel arrays
+
+        Programs don't depend on tempo, size or the chords' pitches, so one
+        compile serves every re-render; notes() times it for a pitch table
+        (see Generator.pitch_table) and a size. Programs of melodies in the
+        extended syntax also keep their parsed Melody, whose size changes
+        are timed by a Clock; None for plain melodies.
+
+        Extended melodies are parsed once while they stay in `melodies`:
+        their length, tempo map and program all come from that parse.
+    """
+
+    __slots__ = ('starts', 'durations', 'chords', 'melody')
+
+    melodies = LRUCache(maxsize=256)
+
+    def __init__(self, starts, durations, chords, melody=None):
+        self.starts = starts
+        self.durations = durations
+        self.chords = chords
+        self.melody = melody
+
+    @classmethod
+    def parse(cls, melody_str):
+        """ the Melody of melody_str, None for a plain melody
+        """
+        if Melody.is_plain(melody_str):
+            return None
+        return cls.melodies.get_or_create(melody_str, lambda: Melody.parse(melody_str))
+
+    @classmethod
+    def compile(cls, melody_str, chord_count):
+        starts = array('L')
+        durations = array('L')
+        chords = array('H')
+        with Metrics.timer('melody_compile'):
+            melody = cls.parse(melody_str)
+            tokens = cls.tokens(melody_str, chord_count) if melody is None else melody.tokens(chord_count)
+            for start, index, duration in tokens:
+                starts.append(start)
+                durations.append(duration)
+                chords.append(index)
+        return cls(starts, durations, chords, melody)
+
+    @staticmethod
+    def canonical(melody_str):
+        """ the melody with spaces dropped and every hold written "_",
+            which plays the same as melody_str; extended melodies are kept
+            as they are, spaces there end section names
+        """
+        if not Melody.is_plain(melody_str):
+            return melody_str
+        return melody_str.replace(' ', '').replace('-', '_')
+
+    @classmethod
+    def tokens(cls, melody_str, chord_count):
+        """ lazy (start, chord index, duration) of every chord played
+
+            Spaces are skipped, "_" and "-" hold the last chord one beat
+            longer, "." is a beat of silence and a digit plays that chord
+            (0 is the last one). A chord is yielded as soon as its duration
+            is known, at the next chord or the end of the string. Melodies
+            using more than that are read by Melody.
+        """
+        if not Melody.is_plain(melody_str):
+            yield from cls.parse(melody_str).tokens(chord_count)
+            return
+        current = None
+        i = 0
+        for char in melody_str:
+            if char == ' ':
+                continue
+            if char in ('_', '-'):
+                if current is None:
+                    raise KeyError(0)
+                current[2] += 1
+            elif char in ('.',):
+                pass
+            else:
+                index = int(char) - 1
+                if not -chord_count <= index < chord_count:
+                    raise IndexError('list index out of range')
+                if current is not None:
+                    yield tuple(current)
+                current = [i, index % chord_count, 1]
+            i += 1
+        if current is not None:
+            yield tuple(current)
+
+    @classmethod
+    def timed(cls, melody_str, chord_count, size, ticks=MidiEncoder.TICKS_PER_QUARTER):
+        """ lazy (start, chord index, tick, duration in ticks) of every chord
+            played, with the melody's size changes
+        """
+        if Melody.is_plain(melody_str):
+            for start, index, duration in cls.tokens(melody_str, chord_count):
+                yield start, index, int(start * size * ticks), int(duration * size * ticks)
+            return
+        melody = cls.parse(melody_str)
+        time = Melody.clock(melody.sizes, size, ticks).time
+        for start, index, duration in melody.tokens(chord_count):
+            tick = int(time(start))
+            yield start, index, tick, int(time(start + duration)) - tick
+
+    def notes(self, pitches, size, velocity, ticks=MidiEncoder.TICKS_PER_QUARTER):
+        """ (tick, duration, pitch, channel, velocity) of every note, pitches
+            being the midi keys of each chord
+        """
+        notes = list()
+        if self.melody is not None:
+            time = Melody.clock(self.melody.sizes, size, ticks).time
+            for start, duration, index in zip(self.starts, self.durations, self.chords):
+                tick = int(time(start))
+                duration = int(time(start + duration)) - tick
+                for pitch in pitches[index]:
+                    notes.append((tick, duration, pitch, 0, velocity))
+            return notes
+        for start, duration, index in zip(self.starts, self.durations, self.chords):
+            tick = int(start * size * ticks)
+            duration = int(duration * size * ticks)
+            for pitch in pitches[index]:
+                notes.append((tick, duration, pitch, 0, velocity))
+        return notes
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class ProgramCache(LRUCache):
+    """ Bounded thread-safe LRU of MelodyPrograms, keyed by
+        (pitch table, melody string)
+    """
+
+    def __init__(self, maxsize=256):
+        super().__init__(maxsize)
+
+    def program(self, key, compile_program):
+        return self.get_or_create(key, compile_program)
+
 
 class Generator:
 
+    VELOCITY = 70
+    # longer melodies are streamed without keeping a program
+    MAX_PROGRAM_LENGTH = 4096
+
+    programs = ProgramCache()
+
     def __init__(self, chords_str=None, size=1/4):
         self.chords = list()
+        # symbols of self.chords, enough to rebuild them
+        self.symbols = list()
+        self._pitches = None
+        self._arrangement = None
         if chords_str:
             self.set_chords(chords_str)
         self.tempo = 120
         self.size = size
 
     def set_tempo(self, tempo):
-        self.tempo = int(tempo)
+        low, high = Melody.TEMPO_RANGE
+        try:
+            tempo = int(tempo)
+        except ValueError:
+            raise ValueError('Bad tempo "{}"'.format(tempo)) from None
+        if not low <= tempo <= high:
+            raise ValueError('Tempo must be from {} to {}'.format(low, high))
+        self.tempo = tempo
 
     def set_size(self, size):
-        self.size = float(size)
+        # "1/4" as the help text shows it, or 0.25
+        try:
+            value = float(Fraction(size) if isinstance(size, str) else size)
+        except (ValueError, ZeroDivisionError, OverflowError):
+            raise ValueError('Bad size "{}"'.format(size)) from None
+        size = value
+        low, high = Melody.SIZE_RANGE
+        if not low <= size <= high:
+            raise ValueError('Size must be from 1/{:.0f} to {:.0f}'.format(1 / low, high))
+        self.size = size
 
     def set_chords(self, chords_str):
-        chords_list = chords_str.split(' ')
-        for chord_name in chords_list:
-            if not chord_name:
-                continue
-            try:
-                chord = ChordParser.chord(chord_name)
-            except TypeError:
-                print('No chord for "{}"'.format(chord_name))
+        """ replace the chordset with the chords of chords_str; returns the
+            symbols that are not chords, which are left out
+        """
+        self.chords = list()
+        self.symbols = list()
+        self._pitches = None
+        self._arrangement = None
+        skipped = list()
+        for result in ChordParser.progression(chords_str):
+            if result.error is not None:
+                logger.debug('No chord for "%s": %s', result.symbol, result.error)
+                skipped.append(result.symbol)
             else:
-                self.chords.append(chord)
+                self.chords.append(result.chord)
+                self.symbols.append(result.symbol)
+        return skipped
+
+    def pitch_table(self):
+        """ midi keys of every chord's notes, in chordset order
+        """
+        if self._pitches is None:
+            self._pitches = tuple(tuple(note.midi_key for note in chord.notes.values())
+                                  for chord in self.chords)
+        return self._pitches
+
+    def arrangement_table(self):
+        """ Arrangement.table() of the chordset: keys, bass and voicing of
+            every chord
+        """
+        if self._arrangement is None:
+            from arrangement import Arrangement
+            self._arrangement = Arrangement.table(self.chords)
+        return self._arrangement
+
+    def program(self, melody_str):
+        """ the cached MelodyProgram of melody_str for this chordset
+        """
+        return self.melody_program(self.pitch_table(), melody_str)
+
+    @classmethod
+    def melody_program(cls, pitches, melody_str):
+        return cls.programs.program(
+            (pitches, melody_str), lambda: MelodyProgram.compile(melody_str, len(pitches)))
+
+    def cache_key(self, melody_str):
+        """ MidiCache key of midi(melody_str) with the current settings
+        """
+        return MidiCache.key(self.pitch_table(), MelodyProgram.canonical(melody_str), self.tempo, self.size)
 
     def parse_melody(self, melody_str):
         melody = dict()
-        prev_note = 0
-        for i, char in enumerate(melody_str.replace(' ', '')):
-            if char in ('_', '-'):
-                melody[prev_note][1] += 1
-            elif char in ('.',):
-                pass
-            else:
-                chord = self.chords[int(char) - 1]
-                notes = chord.notes.values()
-                melody[i] = [notes, 1]
-                prev_note = i
+        with Metrics.timer('melody_parse'):
+            for start, notes, duration in self.iter_melody(melody_str):
+                melody[start] = [notes, duration]
         return melody
 
+    def iter_melody(self, melody_str):
+        """ lazy parse_melody(): (start, notes, duration) of every chord, in order
+        """
+        for start, index, duration in MelodyProgram.tokens(melody_str, len(self.chords)):
+            yield start, self.chords[index].notes.values(), duration
+
+    def iter_notes(self, melody_str):
+        """ notes() straight from a melody string
+        """
+        return self.melody_notes(self.pitch_table(), melody_str, self.size)
+
+    @staticmethod
+    def melody_length(melody_str):
+        """ length of melody_str once its repeats and sections are played
+            out; for a plain melody, its characters other than spaces
+        """
+        melody = MelodyProgram.parse(melody_str)
+        if melody is None:
+            return len(melody_str) - melody_str.count(' ')
+        return melody.steps
+
+    @staticmethod
+    def melody_tempo(melody_str, tempo, size):
+        """ (tempo at tick 0, [(tick, tempo) of later changes]) of melody_str
+            played at tempo and note size
+        """
+        melody = MelodyProgram.parse(melody_str)
+        if melody is None:
+            return tempo, ()
+        return melody.tempo_map(tempo, size, MidiEncoder.TICKS_PER_QUARTER)
+
+    @staticmethod
+    def melody_seconds(melody_str, tempo, size):
+        """ seconds melody_str plays at tempo and note size, from its steps
+            and changes alone
+        """
+        melody = MelodyProgram.parse(melody_str)
+        if melody is None:
+            return (len(melody_str) - melody_str.count(' ')) * size * 60 / tempo
+        ticks = MidiEncoder.TICKS_PER_QUARTER
+        tempo, tempos = melody.tempo_map(tempo, size, ticks)
+        end = Melody.clock(melody.sizes, size, ticks).time(melody.steps)
+        return Clock(60 / tempo / ticks, [(tick, 60 / bpm / ticks) for tick, bpm in tempos]).time(end)
+
+    @classmethod
+    def melody_notes(cls, pitches, melody_str, size):
+        """ notes of melody_str over a pitch table: timed from the cached
+            program, or lazily for melodies too long to keep one
+        """
+        if cls.melody_length(melody_str) <= cls.MAX_PROGRAM_LENGTH:
+            return iter(cls.melody_program(pitches, melody_str).notes(pitches, size, cls.VELOCITY))
+        return cls._lazy_notes(pitches, melody_str, size)
+
+    @classmethod
+    def _lazy_notes(cls, pitches, melody_str, size):
+        for start, index, tick, duration in MelodyProgram.timed(melody_str, len(pitches), size):
+            for pitch in pitches[index]:
+                yield tick, duration, pitch, 0, cls.VELOCITY
+
+    def notes(self, melody):
+        """ (tick, duration, pitch, channel, velocity) of every melody note
+        """
+        ticks = MidiEncoder.TICKS_PER_QUARTER
+        notes = list()
+        for start_beat, beat_data in melody.items():
+            tick = int(start_beat * self.size * ticks)
+            duration = int(beat_data[1] * self.size * ticks)
+            for note in beat_data[0]:
+                notes.append((tick, duration, note.midi_key, 0, self.VELOCITY))
+        return notes
+
     def build_midi(self, melody):
+        with Metrics.timer('midi_encode'):
+            midi = BytesIO(MidiEncoder(self.tempo).encode([self.notes(melody)]))
+        return midi
+
+    def build_midi_midiutil(self, melody):
+        """ the MIDIUtil path build_midi replaced, kept to benchmark against
+        """
+        from midiutil.MidiFile import MIDIFile
         mf = MIDIFile(1)
         track = 0
         channel = 0
-        velocity = 70
+        velocity = self.VELOCITY
 
         mf.addTempo(0, 0, self.tempo)
         for start_beat, beat_data in melody.items():
@@ -65,12 +646,119 @@ class Generator:
         return midi
 
     def midi(self, melody_str):
-        melody = self.parse_melody(melody_str)
-        midi_io = self.build_midi(melody)
+        midi_io = BytesIO(render(self.pitch_table(), melody_str, self.tempo, self.size))
         return midi_io
 
+    def write_midi(self, melody_str, sink, chunk_size=1 << 16):
+        """ stream midi(melody_str) to a writable sink with bounded memory,
+            returns the number of bytes written
+        """
+        tempo, tempos = self.melody_tempo(melody_str, self.tempo, self.size)
+        return MidiEncoder(tempo, tempos=tempos).stream(self.iter_notes(melody_str), sink, chunk_size)
+
+    def wav(self, melody_str, timbre='pluck', sample_rate=22050):
+        """ melody_str synthesized to a WAV file (see Synth)
+        """
+        return BytesIO(render_wav(self.pitch_table(), melody_str, self.tempo, self.size, timbre, sample_rate))
+
+    def arrange(self, melody_str, parts=None):
+        """ melody_str as a multi-track arrangement (see Arrangement)
+        """
+        return BytesIO(render_arrangement(self.arrangement_table(), melody_str, self.tempo, self.size, parts))
+
+
+def render(pitches, melody_str, tempo=120, size=1/4):
+    """ midi(melody_str) bytes of a Generator with this pitch table, tempo
+        and size; plain arguments, so it can run in a worker process
+    """
+    with Metrics.timer('melody_notes'):
+        notes = list(Generator.melody_notes(pitches, melody_str, size))
+    tempo, tempos = Generator.melody_tempo(melody_str, tempo, size)
+    with Metrics.timer('midi_encode'):
+        return MidiEncoder(tempo, tempos=tempos).encode([notes])
+
+
+def render_streamed(pitches, melody_str, tempo=120, size=1/4):
+    """ render() for melodies too long to compile and cache: notes are
+        streamed to the encoder instead of collected; returns the bytes,
+        so it works on workers of other machines too
+    """
+    tempo, tempos = Generator.melody_tempo(melody_str, tempo, size)
+    f = BytesIO()
+    with Metrics.timer('midi_stream'):
+        MidiEncoder(tempo, tempos=tempos).stream(Generator.melody_notes(pitches, melody_str, size), f)
+    return f.getvalue()
+
+
+def render_wav(pitches, melody_str, tempo=120, size=1/4, timbre='pluck', sample_rate=22050):
+    """ render() synthesized to WAV bytes instead of MIDI
+    """
+    from synth import Synth
+    # before any note is made
+    seconds = Generator.melody_seconds(melody_str, tempo, size)
+    if seconds > Synth.MAX_SECONDS:
+        raise ValueError('{:.0f}s of audio is more than {}s'.format(seconds, Synth.MAX_SECONDS))
+    tempo, tempos = Generator.melody_tempo(melody_str, tempo, size)
+    with Metrics.timer('wav_render'):
+        return Synth.get(sample_rate, timbre).wav(
+            Generator.melody_notes(pitches, melody_str, size), tempo, tempos=tempos)
+
+
+def render_arrangement(table, melody_str, tempo=120, size=1/4, parts=None):
+    """ arrange() bytes for an arrangement table, like render()
+    """
+    from arrangement import Arrangement, DEFAULT_PARTS
+    return Arrangement(parts or DEFAULT_PARTS).encode(table, melody_str, tempo, size)
+
+
+def benchmark(length=20000, number=5):
+    """ build_midi against build_midi_midiutil on a melody of `length`
+        characters: seconds per render of each
+    """
+    gen = Generator('Am Dm G C F Bb E7 Am9 Dm7')
+    melody_str = ('1_2.3__4 5-6.7_8 9...1-2-' * (length // 24 + 1))[:length]
+    melody = gen.parse_melody(melody_str)
+    assert gen.build_midi(melody).read() == gen.build_midi_midiutil(melody).read()
+    timings = list()
+    for build in (gen.build_midi, gen.build_midi_midiutil):
+        start = time.perf_counter()
+        for _ in range(number):
+            build(melody)
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+
+def benchmark_stream(length=200000):
+    """ midi() against write_midi() to a temporary file on a melody of
+        `length` characters: (seconds, peak traced bytes) of each
+    """
+    gen = Generator('Am Dm G C F Bb E7 Am9 Dm7')
+    melody_str = ('1_2.3__4 5-6.7_8 9...1-2-' * (length // 24 + 1))[:length]
+
+    def stream():
+        with tempfile.TemporaryFile() as f:
+            gen.write_midi(melody_str, f)
+
+    results = list()
+    for render in (lambda: gen.midi(melody_str).read(), stream):
+        tracemalloc.start()
+        start = time.perf_counter()
+        render()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append((seconds, peak))
+    return results
+
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        print('encoder {:.4f}s, MIDIUtil {:.4f}s per render'.format(*benchmark()))
+        (midi_time, midi_peak), (stream_time, stream_peak) = benchmark_stream()
+        print('midi() {:.3f}s {:.1f} MB peak, write_midi() {:.3f}s {:.1f} MB peak'.format(
+            midi_time, midi_peak / 1e6, stream_time, stream_peak / 1e6))
+        sys.exit()
+
     chords_str = 'Em C G D Em7'
     gen = Generator(chords_str)
     gen.set_tempo(120)
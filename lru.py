@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Bounded thread-safe LRU map
+
+        Keeps at most `maxsize` entries and, with a weigh function (value ->
+        size), at most `max_weight` in total, least recently used first
+        out; a value heavier than max_weight alone is not kept. With a ttl,
+        entries unused for that many seconds are dropped when met. get()
+        counts hits and misses, trimming counts evictions. None values
+        can't be told from misses, don't store them.
+    """
+
+    def __init__(self, maxsize=None, max_weight=None, weigh=None, ttl=None):
+        self.maxsize = maxsize
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.weight = 0
+        # key -> [value, last use]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None:
+                now = time.monotonic()
+                if now - entry[1] > self.ttl:
+                    self._pop(key)
+                    entry = None
+                else:
+                    entry[1] = now
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        weight = self.weigh(value) if self.weigh is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            if self.max_weight is not None and weight > self.max_weight:
+                return value
+            now = time.monotonic() if self.ttl is not None else None
+            self._entries[key] = [value, now]
+            self.weight += weight
+            self._trim(now)
+        return value
+
+    def get_or_create(self, key, create):
+        """ the value of key, create() (called unlocked) and kept on a miss
+        """
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, create())
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+            self.hits = self.misses = self.evictions = 0
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._entries),
+            maxsize=self.maxsize,
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _pop(self, key):
+        value = self._entries.pop(key)[0]
+        if self.weigh is not None:
+            self.weight -= self.weigh(value)
+        return value
+
+    def _trim(self, now):
+        while self._entries:
+            key, (value, used) = next(iter(self._entries.items()))
+            if ((self.maxsize is None or len(self._entries) <= self.maxsize)
+                    and (self.max_weight is None or self.weight <= self.max_weight)
+                    and (now is None or now - used <= self.ttl)):
+                break
+            self._pop(key)
+            self.evictions += 1
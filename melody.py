@@ -0,0 +1,338 @@
+import re
+from bisect import bisect_right
+from collections import namedtuple
+from fractions import Fraction
+
+
+class MelodyError(ValueError):
+
+    def __init__(self, message, melody_str, position):
+        self.melody = melody_str
+        self.position = position
+        excerpt = melody_str[max(0, position - 12):position + 12]
+        super().__init__('{} at position {} ("{}")'.format(message, position, excerpt))
+
+
+# ops of a Phrase
+PLAY, HOLD, REST, REPEAT, TEMPO, SIZE = range(6)
+
+
+class Phrase(namedtuple('Phrase', 'ops steps changes')):
+    """ a compiled run of melody: ops are (PLAY, chord index), (HOLD, beats),
+        (REST, beats), (REPEAT, phrase, times), (TEMPO, bpm) and
+        (SIZE, note size); steps and changes count the beats and the
+        tempo and size changes of one pass, repeats expanded
+    """
+
+
+class Clock:
+    """ Piecewise linear position -> time: `rate` time per position from 0
+        on, then every (position, rate) of changes from its position on
+    """
+
+    def __init__(self, rate, changes=()):
+        self.positions = [0]
+        self.origins = [0.0]
+        self.rates = [rate]
+        for position, rate in changes:
+            if position == self.positions[-1]:
+                self.rates[-1] = rate
+                continue
+            self.origins.append(self.time(position))
+            self.positions.append(position)
+            self.rates.append(rate)
+
+    def time(self, position):
+        k = bisect_right(self.positions, position) - 1
+        return self.origins[k] + (position - self.positions[k]) * self.rates[k]
+
+    def rate(self, position):
+        """ time per position at position
+        """
+        return self.rates[bisect_right(self.positions, position) - 1]
+
+
+class Melody:
+    """ Melody string with repeats, sections and tempo and size changes,
+        compiled to a tree of Phrases
+
+        On top of the plain syntax (digits, "_" or "-" holds, "." rests,
+        spaces):
+
+            [12]           chord 12, for chordsets longer than 9
+            (1_2_)x8       a group, played 8 times ("x8" is optional)
+            verse{1_2_}    defines section "verse" and plays it
+            verse          plays it again (letters only, defined before)
+            versex3        plays it 3 times, unless there is a section
+                           "versex" (then it is that and chord 3)
+            <tempo=96>     tempo from here on, in beats per minute
+            <size=1/8>     note size from here on
+            |              a bar line, ignored like spaces
+
+        Repeats and sections stay folded: a section is one Phrase however
+        often it plays and events() expands repeats as it goes, so parsing
+        costs the length of the source, not of the song. Phrases know their
+        expanded length, which is checked against MAX_STEPS at parse time.
+    """
+
+    PLAIN = frozenset('0123456789_-. ')
+    DIGITS = '0123456789'
+    NAME = re.compile(r'[A-Za-z]+')
+    INDEX = re.compile(r'\[(\d+)\]')
+    TIMES = re.compile(r'x(\d+)')
+    DIRECTIVE = re.compile(r'<\s*(tempo|size)\s*=\s*([^>]*?)\s*>')
+    MAX_STEPS = 1 << 20
+    MAX_CHANGES = 1 << 12
+    MAX_DEPTH = 32
+    TEMPO_RANGE = 10, 1000
+    # note sizes; the bot's 4096 beats (ChordBot.MAX_BEATS) of the largest keep
+    # every MIDI delta time within its 4 byte limit (0x0FFFFFFF ticks)
+    SIZE_RANGE = 1 / 256, 64
+
+    __slots__ = ('phrase', 'sections', 'lowest', 'highest', 'tempos', 'sizes')
+
+    def __init__(self, phrase, sections, lowest, highest):
+        self.phrase = phrase
+        self.sections = sections
+        self.lowest = lowest
+        self.highest = highest
+        self.tempos = list()
+        self.sizes = list()
+        self._changes(phrase, 0)
+
+    @classmethod
+    def is_plain(cls, melody_str):
+        """ whether melody_str only uses the plain syntax, which
+            MelodyProgram.tokens reads without compiling
+        """
+        return cls.PLAIN.issuperset(melody_str)
+
+    @property
+    def steps(self):
+        return self.phrase.steps
+
+    @classmethod
+    def parse(cls, melody_str):
+        sections = dict()
+        # (ops, closing bracket, section name, position of the opening
+        # bracket) of every open phrase
+        frames = [(list(), None, None, 0)]
+        lowest = highest = None
+        i = 0
+        while i < len(melody_str):
+            char = melody_str[i]
+            ops = frames[-1][0]
+            if char in ' |':
+                i += 1
+            elif char in '_-':
+                cls._extend(ops, HOLD)
+                i += 1
+            elif char == '.':
+                cls._extend(ops, REST)
+                i += 1
+            elif char in cls.DIGITS or char == '[':
+                if char == '[':
+                    match = cls.INDEX.match(melody_str, i)
+                    if match is None or int(match.group(1)) == 0:
+                        raise MelodyError('Bad chord number', melody_str, i)
+                    index = int(match.group(1)) - 1
+                    i = match.end()
+                else:
+                    index = int(char) - 1
+                    i += 1
+                ops.append((PLAY, index))
+                lowest = index if lowest is None else min(lowest, index)
+                highest = index if highest is None else max(highest, index)
+            elif char == '(':
+                frames.append((list(), ')', None, i))
+                i += 1
+            elif char in ')}':
+                ops, closing, name, position = frames.pop()
+                if closing != char:
+                    raise MelodyError('Unexpected "{}"'.format(char), melody_str, i)
+                phrase = cls._phrase(ops, melody_str, position)
+                if name is not None:
+                    sections[name] = phrase
+                i = cls._play(frames[-1][0], phrase, melody_str, i + 1)
+            elif char == '<':
+                match = cls.DIRECTIVE.match(melody_str, i)
+                if match is None:
+                    raise MelodyError('Bad tempo or size', melody_str, i)
+                ops.append(cls._directive(match.group(1), match.group(2), melody_str, i))
+                i = match.end()
+            elif cls.NAME.match(char):
+                name = cls.NAME.match(melody_str, i).group()
+                end = i + len(name)
+                if melody_str.startswith('{', end):
+                    frames.append((list(), '}', name, end))
+                    i = end + 1
+                else:
+                    if name not in sections and name.endswith('x') and name[:-1] in sections \
+                            and melody_str[end:end + 1].isdigit():
+                        # NAME took the x of "versex2", verse played twice
+                        name = name[:-1]
+                        end -= 1
+                    if name not in sections:
+                        if len(name) > 24:
+                            name = name[:23] + '…'
+                        raise MelodyError('Unknown section "{}"'.format(name), melody_str, i)
+                    i = cls._play(ops, sections[name], melody_str, end)
+            else:
+                raise MelodyError('Unexpected "{}"'.format(char), melody_str, i)
+            if len(frames) > cls.MAX_DEPTH:
+                raise MelodyError('Nested too deep', melody_str, i)
+        if len(frames) > 1:
+            position = frames[-1][3]
+            raise MelodyError('Unclosed "{}"'.format(melody_str[position]), melody_str, position)
+        return cls(cls._phrase(frames[0][0], melody_str, 0), sections, lowest, highest)
+
+    @staticmethod
+    def _extend(ops, kind):
+        if ops and ops[-1][0] == kind:
+            ops[-1] = kind, ops[-1][1] + 1
+        else:
+            ops.append((kind, 1))
+
+    @classmethod
+    def _play(cls, ops, phrase, melody_str, i):
+        """ add a REPEAT of phrase, times as given by an "xN" at i; returns
+            the position after it
+        """
+        times = 1
+        match = cls.TIMES.match(melody_str, i)
+        if match is not None:
+            times = int(match.group(1))
+            if times == 0:
+                raise MelodyError('Repeated 0 times', melody_str, i)
+            i = match.end()
+        if phrase.steps * times > cls.MAX_STEPS:
+            raise MelodyError('Longer than {} beats'.format(cls.MAX_STEPS), melody_str, i)
+        if phrase.changes * times > cls.MAX_CHANGES:
+            raise MelodyError('More than {} tempo and size changes'.format(cls.MAX_CHANGES), melody_str, i)
+        ops.append((REPEAT, phrase, times))
+        return i
+
+    @classmethod
+    def _directive(cls, kind, value, melody_str, i):
+        try:
+            if kind == 'tempo':
+                tempo = int(value)
+                if not cls.TEMPO_RANGE[0] <= tempo <= cls.TEMPO_RANGE[1]:
+                    raise ValueError(tempo)
+                return TEMPO, tempo
+            size = float(Fraction(value))
+            if not cls.SIZE_RANGE[0] <= size <= cls.SIZE_RANGE[1]:
+                raise ValueError(size)
+            return SIZE, size
+        except (ValueError, ZeroDivisionError, OverflowError):
+            raise MelodyError('Bad {} "{}"'.format(kind, value), melody_str, i) from None
+
+    @classmethod
+    def _phrase(cls, ops, melody_str, position):
+        steps = changes = 0
+        for op in ops:
+            if op[0] == PLAY:
+                steps += 1
+            elif op[0] in (HOLD, REST):
+                steps += op[1]
+            elif op[0] == REPEAT:
+                steps += op[1].steps * op[2]
+                changes += op[1].changes * op[2]
+            else:
+                changes += 1
+        if steps > cls.MAX_STEPS:
+            raise MelodyError('Longer than {} beats'.format(cls.MAX_STEPS), melody_str, position)
+        if changes > cls.MAX_CHANGES:
+            raise MelodyError('More than {} tempo and size changes'.format(cls.MAX_CHANGES), melody_str, position)
+        return Phrase(tuple(ops), steps, changes)
+
+    def _changes(self, phrase, step):
+        """ collect (step, tempo) and (step, size) of every change; phrases
+            without changes are skipped whole
+        """
+        for op in phrase.ops:
+            kind = op[0]
+            if kind == PLAY:
+                step += 1
+            elif kind in (HOLD, REST):
+                step += op[1]
+            elif kind == REPEAT:
+                if not op[1].changes:
+                    step += op[1].steps * op[2]
+                    continue
+                for _ in range(op[2]):
+                    step = self._changes(op[1], step)
+            elif kind == TEMPO:
+                self.tempos.append((step, op[1]))
+            else:
+                self.sizes.append((step, op[1]))
+        return step
+
+    def events(self):
+        """ lazy ops of the melody, repeats expanded
+        """
+        # [ops, next op, passes left] of every phrase being played
+        stack = [[self.phrase.ops, 0, 1]]
+        while stack:
+            frame = stack[-1]
+            ops = frame[0]
+            if frame[1] == len(ops):
+                frame[2] -= 1
+                if frame[2]:
+                    frame[1] = 0
+                else:
+                    stack.pop()
+                continue
+            op = ops[frame[1]]
+            frame[1] += 1
+            if op[0] == REPEAT:
+                stack.append([op[1].ops, 0, op[2]])
+            else:
+                yield op
+
+    def tokens(self, chord_count):
+        """ lazy (start, chord index, duration) of every chord played, as
+            MelodyProgram.tokens gives them for a plain melody
+        """
+        if self.highest is not None and not -chord_count <= self.lowest <= self.highest < chord_count:
+            raise IndexError('list index out of range')
+        current = None
+        step = 0
+        for op in self.events():
+            kind = op[0]
+            if kind == PLAY:
+                if current is not None:
+                    yield tuple(current)
+                current = [step, op[1] % chord_count, 1]
+                step += 1
+            elif kind == HOLD:
+                if current is None:
+                    raise KeyError(0)
+                current[2] += op[1]
+                step += op[1]
+            elif kind == REST:
+                step += op[1]
+        if current is not None:
+            yield tuple(current)
+
+    @staticmethod
+    def clock(sizes, size, ticks):
+        """ Clock of step -> tick for (step, size) changes, at note size
+            `size` until the first
+        """
+        return Clock(size * ticks, [(step, changed * ticks) for step, changed in sizes])
+
+    def tempo_map(self, tempo, size, ticks):
+        """ (tempo at tick 0, [(tick, tempo) of every later change])
+        """
+        changes = list()
+        clock = self.clock(self.sizes, size, ticks)
+        for step, bpm in self.tempos:
+            tick = int(clock.time(step))
+            if tick == 0:
+                tempo = bpm
+            elif changes and changes[-1][0] == tick:
+                changes[-1] = tick, bpm
+            else:
+                changes.append((tick, bpm))
+        return tempo, changes
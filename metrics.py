@@ -0,0 +1,240 @@
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class Metrics:
+    """ Per-stage timers and event counters of the bot's hot paths
+
+        Off by default: timer() hands out a shared no-op context and count()
+        returns at once while Metrics.enabled is false, so instrumented call
+        sites cost a call and a flag check. Stage times go to histograms;
+        collectors (stats dicts of caches, sessions and pools) are read only
+        when metrics are rendered. render() writes the Prometheus text
+        format, serve() exposes it over HTTP. Stages run by worker
+        processes are timed in those processes, not here.
+    """
+
+    enabled = False
+    PREFIX = 'chord_bot'
+    # histogram bucket bounds, seconds
+    BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    _off = nullcontext()
+    _lock = threading.Lock()
+    # stage -> [bucket counts..., +Inf count, total seconds]
+    _stages = dict()
+    _events = dict()
+    _collectors = dict()
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+
+    @classmethod
+    def timer(cls, stage):
+        """ context timing its block as `stage`
+        """
+        if not cls.enabled:
+            return cls._off
+        return StageTimer(cls, stage)
+
+    @classmethod
+    def observe(cls, stage, seconds):
+        with cls._lock:
+            entry = cls._stages.get(stage)
+            if entry is None:
+                entry = cls._stages[stage] = [0] * (len(cls.BUCKETS) + 1) + [0.0]
+            entry[bisect_left(cls.BUCKETS, seconds)] += 1
+            entry[-1] += seconds
+
+    @classmethod
+    def count(cls, event, amount=1):
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._events[event] = cls._events.get(event, 0) + amount
+
+    @classmethod
+    def collect(cls, name, stats):
+        """ report the numbers of stats() (a dict, like the caches' .stats)
+            as gauges named after name and the key
+        """
+        cls._collectors[name] = stats
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._stages.clear()
+            cls._events.clear()
+
+    @classmethod
+    def snapshot(cls):
+        """ stage -> (count, total seconds), event -> count
+        """
+        with cls._lock:
+            stages = {stage: (sum(entry[:-1]), entry[-1]) for stage, entry in cls._stages.items()}
+            return stages, dict(cls._events)
+
+    @classmethod
+    def render(cls):
+        """ everything in the Prometheus text exposition format
+        """
+        name = cls.PREFIX + '_stage_seconds'
+        lines = ['# HELP {} Time spent per stage'.format(name), '# TYPE {} histogram'.format(name)]
+        with cls._lock:
+            stages = sorted((stage, list(entry)) for stage, entry in cls._stages.items())
+            events = sorted(cls._events.items())
+        for stage, entry in stages:
+            total = 0
+            for bound, count in zip(cls.BUCKETS + ('+Inf',), entry[:-1]):
+                total += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, total))
+            lines.append('{}_sum{{stage="{}"}} {!r}'.format(name, stage, entry[-1]))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, total))
+        name = cls.PREFIX + '_events_total'
+        lines += ['# HELP {} Events counted on hot paths'.format(name), '# TYPE {} counter'.format(name)]
+        for event, count in events:
+            lines.append('{}{{event="{}"}} {}'.format(name, event, count))
+        for collector, stats in sorted(cls._collectors.items()):
+            try:
+                values = stats()
+            except Exception:
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool):
+                    value = int(value)
+                if value is None or not isinstance(value, (int, float)):
+                    continue
+                gauge = '{}_{}_{}'.format(cls.PREFIX, collector, key)
+                lines.append('# TYPE {} gauge'.format(gauge))
+                lines.append('{} {}'.format(gauge, value))
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def serve(cls, port=9100, host='127.0.0.1'):
+        """ enable metrics and serve them in a daemon thread: GET /metrics,
+            GET /profile?seconds=5 for Profiler stacks; returns the server
+        """
+        cls.enable()
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+class StageTimer:
+
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """ Sampling profiler: every `interval` seconds it records the Python
+        stack of every other thread. folded() gives the samples in the
+        collapsed format flame graph tools read, one
+        "thread;outer;...;inner count" line per distinct stack.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self._stacks = dict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ';'.join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def folded(self):
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self._stacks.items()))
+
+    @classmethod
+    def profile(cls, seconds, interval=0.005):
+        """ folded() stacks of the next `seconds`
+        """
+        profiler = cls(interval).start()
+        time.sleep(seconds)
+        return profiler.stop().folded()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    MAX_PROFILE_SECONDS = 60
+    MIN_PROFILE_INTERVAL = 0.001
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            body = Metrics.render()
+            content_type = 'text/plain; version=0.0.4'
+        elif url.path == '/profile':
+            query = dict(parse_qsl(url.query))
+            try:
+                # max(bound, nan) is the bound, so nan is clamped too
+                seconds = max(0, min(float(query.get('seconds', 5)), self.MAX_PROFILE_SECONDS))
+                interval = max(self.MIN_PROFILE_INTERVAL, float(query.get('interval', 0.005)))
+            except ValueError:
+                self.send_error(400)
+                return
+            body = Profiler.profile(seconds, interval)
+            content_type = 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
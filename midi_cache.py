@@ -0,0 +1,210 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from lru import LRUCache
+
+
+class MidiCache:
+    """ Content-addressed cache of rendered MIDI files
+
+        Keys are key() hashes of what a render depends on. Payloads are kept
+        in a memory LRU of at most max_memory bytes and, if a directory is
+        given, in <key>.mid files there up to max_disk bytes (least recently
+        used files go first, down to LOW_WATER of it so a full cache is not
+        rescanned on every write). Entries unused for ttl seconds expire.
+        The Telegram file_id of an uploaded payload is kept with it so a
+        repeat can be sent without uploading the bytes again.
+    """
+
+    LOW_WATER = 0.9
+
+    def __init__(self, path=None, max_memory=32 << 20, max_disk=256 << 20, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.ttl = ttl
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = LRUCache(max_weight=max_memory, weigh=len, ttl=ttl)
+        # key -> (file name, file_id, time it was set)
+        self._file_ids = LRUCache(maxsize=1024)
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._disk_bytes = sum(size for name, size, used in self._disk_entries())
+
+    @staticmethod
+    def key(pitches, melody_str, tempo, size):
+        """ hash of a render: the chords' midi keys, the canonical melody
+            (MelodyProgram.canonical), tempo and note size
+        """
+        canonical = repr((tuple(map(tuple, pitches)), melody_str, int(tempo), float(size)))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @property
+    def hits(self):
+        return self._memory.hits
+
+    @property
+    def blocking(self):
+        """ whether get() and put() touch the disk
+        """
+        return self.path is not None
+
+    def cached(self, key):
+        """ the payload of key if it is in memory, else None
+        """
+        return self._memory.get(key)
+
+    def get(self, key):
+        data = self._memory.get(key)
+        if data is not None:
+            return data
+        data = self._read(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        return self._memory.put(key, data)
+
+    def put(self, key, data):
+        data = bytes(data)
+        self._memory.put(key, data)
+        if self.path is not None:
+            self._write(key, data)
+
+    def render(self, key, render):
+        """ the cached payload of key, rendered and stored on a miss
+        """
+        data = self.get(key)
+        if data is None:
+            data = bytes(render())
+            self.put(key, data)
+        return data
+
+    def file_id(self, key, filename):
+        """ Telegram file_id of key uploaded as filename, if still fresh
+        """
+        entry = self._file_ids.get(key)
+        if entry is None or entry[0] != filename:
+            return None
+        if time.monotonic() - entry[2] > self.ttl:
+            self._file_ids.pop(key)
+            return None
+        return entry[1]
+
+    def set_file_id(self, key, filename, file_id):
+        # ids are tiny, keep about as many as payloads
+        self._file_ids.maxsize = max(1024, len(self._memory))
+        self._file_ids.put(key, (filename, file_id, time.monotonic()))
+
+    def clear(self):
+        self._memory.clear()
+        self._file_ids.clear()
+        with self._lock:
+            self.disk_hits = self.misses = self.evictions = 0
+            if self.path is not None:
+                for name, size, used in self._disk_entries():
+                    self._remove(name)
+                self._disk_bytes = 0
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            evictions=self._memory.evictions + self.evictions,
+            size=len(self._memory),
+            memory_bytes=self._memory.weight,
+            disk_bytes=self._disk_bytes,
+            file_ids=len(self._file_ids),
+        )
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __contains__(self, key):
+        return key in self._memory
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.mid')
+
+    def _read(self, key):
+        if self.path is None:
+            return None
+        path = self._file(key)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                with self._lock:
+                    self._remove(key + '.mid')
+                    self.evictions += 1
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mtime is the last use, for expiry and eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write(self, key, data):
+        if len(data) > self.max_disk:
+            return
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        path = self._file(key)
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(temp, path)
+        with self._lock:
+            self._disk_bytes += len(data) - replaced
+            if self._disk_bytes > self.max_disk:
+                self._trim_disk()
+
+    def _trim_disk(self):
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        now = time.time()
+        # resync with what is actually on disk, _remove keeps it from here
+        self._disk_bytes = sum(size for name, size, used in entries)
+        low_water = self.max_disk * self.LOW_WATER
+        for name, size, used in entries:
+            if self._disk_bytes <= low_water and now - used <= self.ttl:
+                break
+            self._remove(name)
+            self.evictions += 1
+
+    def _disk_entries(self):
+        """ (file name, size, last use) of every payload on disk
+        """
+        entries = list()
+        with os.scandir(self.path) as scan:
+            for entry in scan:
+                if entry.name.endswith('.mid'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _remove(self, name):
+        """ remove a payload and take its size off disk_bytes; call with
+            the lock held
+        """
+        path = os.path.join(self.path, name)
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self._disk_bytes = max(0, self._disk_bytes - size)
@@ -6,6 +6,14 @@ class Semitone:
 
 
 class Note:
+    """ Immutable note backed by an absolute pitch (octave * 12 + semitone)
+
+        Instances are interned per (pitch, gamma), so arithmetic is an integer
+        operation plus a table lookup and equal notes are the same object.
+        set_gamma() returns the respelled note instead of changing this one.
+    """
+
+    __slots__ = ('pitch', 'key', 'octave', '_gamma_index')
 
     MAJOR = {
         'C': Semitone('C'),
@@ -37,86 +45,113 @@ class Note:
         'B': Semitone('B'),
     }
 
-    def __init__(self, key, octave=1, gamma=None):
-        self.key = str(key).strip()[:2].capitalize()
-        self.octave = octave
+    GAMMAS = MAJOR, MINOR
+    # semitone -> name, per gamma
+    NAMES = tuple(tuple(gamma) for gamma in GAMMAS)
+    # name -> semitone, per gamma
+    INDEXES = tuple({name: i for i, name in enumerate(gamma)} for gamma in GAMMAS)
+    # gamma of .minor: natural notes keep the major gamma, as Note(name) does
+    MINOR_GAMMA_INDEX = tuple(0 if semitone.is_note else 1 for semitone in MINOR.values())
+    A_PITCH = 12 + INDEXES[0]['A']
+
+    _interned = dict()
+
+    def __new__(cls, key, octave=1, gamma=None):
+        key = str(key).strip()[:2].capitalize()
         if gamma is None:
-            self.gamma = self.get_gamma()
+            gamma_index = 0 if key in cls.INDEXES[0] else 1
         else:
-            self.gamma = gamma
+            gamma_index = cls.gamma_index(gamma)
+        semitone = cls.INDEXES[0].get(key)
+        if semitone is None:
+            semitone = cls.INDEXES[1].get(key)
+            if semitone is None:
+                raise ValueError('Unknown note "{}"'.format(key))
+        return cls.intern(octave * 12 + semitone, gamma_index)
+
+    @classmethod
+    def intern(cls, pitch, gamma_index=0):
+        note = cls._interned.get((pitch, gamma_index))
+        if note is None:
+            note = object.__new__(cls)
+            octave, semitone = divmod(pitch, 12)
+            object.__setattr__(note, 'pitch', pitch)
+            object.__setattr__(note, 'key', cls.NAMES[gamma_index][semitone])
+            object.__setattr__(note, 'octave', octave)
+            object.__setattr__(note, '_gamma_index', gamma_index)
+            cls._interned[pitch, gamma_index] = note
+        return note
+
+    @classmethod
+    def gamma_index(cls, gamma):
+        if gamma is cls.MAJOR:
+            return 0
+        if gamma is cls.MINOR:
+            return 1
+        return cls.GAMMAS.index(gamma)
+
+    @property
+    def gamma(self):
+        return self.GAMMAS[self._gamma_index]
+
+    @property
+    def semitone(self):
+        return self.pitch % 12
 
     def get_gamma(self):
-        if self.key in self.MAJOR:
-            gamma = self.MAJOR
-        else:
-            gamma = self.MINOR
-        return gamma
+        return self.gamma
 
     def set_gamma(self, gamma):
-        self.key = gamma[list(gamma)[list(self.gamma).index(self.key)]].name
-        self.gamma = gamma
+        return self.intern(self.pitch, self.gamma_index(gamma))
 
     @property
     def minor(self):
-        gamma = self.MINOR
-        key = gamma[list(gamma)[list(self.gamma).index(self.key)]]
-        return Note(key.name, octave=self.octave)
+        return self.intern(self.pitch, self.MINOR_GAMMA_INDEX[self.pitch % 12])
 
     @property
     def major(self):
-        gamma = self.MAJOR
-        key = gamma[list(gamma)[list(self.gamma).index(self.key)]]
-        return Note(key.name, octave=self.octave)
+        return self.intern(self.pitch, 0)
 
     @property
     def name(self):
-        major = self.major
-        return major.key
+        return self.NAMES[0][self.pitch % 12]
 
     @property
     def frequency(self):
-        n = self - Note('A')
+        n = self.pitch - self.A_PITCH
         f0 = 440 * 2 ** (n / 12)
         return f0
 
     @property
     def midi_key(self):
-        n = Note('A') - self + 49
-        return n
+        # A_PITCH sounds at 440 Hz (see frequency), MIDI key 69
+        return self.pitch - self.A_PITCH + 69
 
     def __add__(self, other):
         assert isinstance(other, int)
-        octave, semitones = divmod(other, 12)
-        keys = self.gamma
-        key = list(keys).index(self.key)
-        key += semitones
-        inc_octave, clean_key = divmod(key, 12)
-        octave += inc_octave + self.octave
-        key = clean_key - inc_octave * 12
-        key_char = keys[list(keys)[key]]
-        return Note(key_char.name, octave=octave, gamma=self.gamma)
+        return self.intern(self.pitch + other, self._gamma_index)
 
     def __sub__(self, other):
         if isinstance(other, Note):
-            keys = self.MAJOR
-            key0 = list(keys).index(self.major.key)
-            key = list(keys).index(other.major.key)
-            diff = (self.octave - other.octave) * 12 - (key - key0)
-            return diff
+            return self.pitch - other.pitch
 
         elif isinstance(other, int):
-            return self.__add__(-other)
-
-    def __str__(self):
-        return '{}{}'.format(self.key, self.octave)
-
-    def __repr__(self):
-        return '{}{}'.format(self.key, self.octave)
-
-
+            return self.intern(self.pitch - other, self._gamma_index)
 
+    def __setattr__(self, key, value):
+        raise AttributeError('Note is immutable')
 
+    def __reduce__(self):
+        return Note.intern, (self.pitch, self._gamma_index)
 
+    def __copy__(self):
+        return self
 
+    def __deepcopy__(self, memo):
+        return self
 
+    def __str__(self):
+        return '{}{}'.format(self.key, self.octave)
 
+    def __repr__(self):
+        return '{}{}'.format(self.key, self.octave)
@@ -1,5 +1,11 @@
+import random
 import re
-from chord import ChordBuilder
+import sys
+import time
+from collections import namedtuple
+from chord import BuildTrace, ChordBuilder, Fretboard
+from lru import LRUCache
+from metrics import Metrics
 from note import Note
 
 
@@ -11,50 +17,197 @@ Am/G# Amaj Amin AM7 AM Amaug Aaug G/H/A#
 """.split(' ')
 
 
+class ChordCache(LRUCache):
+    """ Bounded thread-safe LRU of compiled chords, keyed by normalized symbol
+
+        Entries are immutable CompiledChord tuples; builder() hands out a
+        fresh ChordBuilder each time, so callers can't corrupt cached entries.
+    """
+
+    def __init__(self, maxsize=1024):
+        super().__init__(maxsize)
+
+    def builder(self, symbol, compile_chord):
+        return ChordBuilder.from_compiled(self.compiled(symbol, compile_chord))
+
+    def compiled(self, symbol, compile_chord):
+        return self.get_or_create(symbol, lambda: compile_chord(symbol))
+
+
+class ChordSyntaxError(ValueError):
+
+    def __init__(self, message, symbol, position):
+        self.symbol = symbol
+        self.position = position
+        super().__init__('{} at position {} in "{}"'.format(message, position, symbol))
+
+
+class Step(namedtuple('Step', 'op step')):
+    """ an alteration token: op is the prefix (maj, add, b, #, sus, no...)
+    """
+
+
+class ChordSymbol(namedtuple('ChordSymbol', 'tonic quality modifier extensions alterations omissions bass is_bms')):
+    """ Parsed chord symbol
+
+        quality: '', 'm', 'maj' or 'sus'; modifier: '', 'dim' or 'aug'
+        extensions: Steps that add notes ('', 'maj', 'add', '/'), in order
+        alterations: Steps that change notes ('b', '-', '#', '+', 'sus')
+        omissions: steps to drop ('no', 'omit')
+        bass: slash bass note names
+        is_bms: trailing "+"
+    """
+
+
+ChordResult = namedtuple('ChordResult', 'symbol chord error')
+
+
 class ChordParser:
+    """ Single-scan compiled chord symbol grammar
+
+        symbol     := tonic [quality] [modifier] (step | bass | other)* ["+"]
+        tonic      := A-H ["b" | "#"]
+        quality    := "sus" (not before a digit) | "m" (not before "aj")
+                    | "maj" (not before a digit)
+        modifier   := "dim" | "aug"
+        step       := ["#" | "b" | "+" | "-" | "/" | "add" | "sus" | "no"
+                       | "omit" | "maj"] digits
+        bass       := "/" A-H ["b" | "#" | "+" | "-"]
 
-    BASE_PATTERS = re.compile(r"^([A-H][b#]?)(sus(?!\d)|m(?!aj)|maj(?!\d)||[+-])(dim|aug|)")
-    ALTERATIONS_PATTERN = re.compile(r"((?:[#b+-/]|add|sus|no|omit|maj|))(\d+)")
-    BASS_PATTERN = re.compile(r"/([A-H][b#+-]?)")
+        Aliases (H, Ø, °, Δ, M...) are expanded first, only if present.
+        The body after the tonic is scanned once by TOKEN_PATTERN; characters
+        matching nothing are skipped.
+    """
+
+    ALIASES = {
+        'H': 'B',
+        'Ø': 'm7b5',
+        '°7': 'dim7',
+        '°': 'dim7',
+        'o7': 'dim7',
+        'Δ7': 'maj7',
+        'Δ': 'maj7',
+        'M': 'maj',
+    }
+    # first char -> aliases starting with it, longest first
+    ALIAS_STARTS = dict()
+    for pattern, replace in ALIASES.items():
+        ALIAS_STARTS.setdefault(pattern[0], list()).append((pattern, replace))
+    for starts in ALIAS_STARTS.values():
+        starts.sort(key=lambda alias: -len(alias[0]))
+    del pattern, replace, starts
+
+    HEAD_PATTERN = re.compile(r"(?P<tonic>[A-H][b#]?)(?P<quality>sus(?!\d)|m(?!aj)|maj(?!\d)|)(?P<modifier>dim|aug|)")
+    # a bass sign before digits is also a step: "/Bb5" is bass Bb and b5
+    TOKEN_PATTERN = re.compile(
+        r"/(?P<bass>[A-H])(?:(?P<sign>[b#+-])(?!\d)|(?=(?P<step_sign>[b#+-])\d))?"
+        r"|(?P<op>[#b+,\-./]|add|sus|no|omit|maj|)(?P<step>\d+)"
+    )
+    EXTENSIONS = '', 'maj', 'add', '/'
+    # highest step a symbol may name, two octaves up; a chord is built
+    # step by step and its notes are interned for good
+    MAX_STEP = 15
+    ALTERATIONS = 'b', '-', '#', '+', 'sus'
+    OMISSIONS = 'no', 'omit'
+
+    cache = ChordCache()
+    # precomputed ChordTable (see chord_table.py), probed before the cache
+    table = None
+
+    @classmethod
+    def expand(cls, chord):
+        """ expand aliases in one scan
+
+            returns the expanded text and, if anything was expanded, the
+            position in chord of every expanded character
+        """
+        if cls.ALIAS_STARTS.keys().isdisjoint(chord):
+            return chord, None
+        text = list()
+        origins = list()
+        applied = list()
+        i = 0
+        n = len(chord)
+        while i < n:
+            char = chord[i]
+            for pattern, replace in cls.ALIAS_STARTS.get(char, ()):
+                if chord.startswith(pattern, i):
+                    text.append(replace)
+                    origins.extend([i] * len(replace))
+                    applied.append(pattern)
+                    i += len(pattern)
+                    break
+            else:
+                text.append(char)
+                origins.append(i)
+                i += 1
+        text = ''.join(text)
+        if BuildTrace.enabled:
+            for pattern in dict.fromkeys(applied):
+                BuildTrace.emit('alias', detail=(pattern, chord, text))
+        return text, origins
+
+    @classmethod
+    def normalize(cls, chord):
+        return cls.expand(chord.strip())[0]
 
     @classmethod
     def parse(cls, chord):
-        print(chord)
-        to_replace = {
-            'H': 'B',
-            'Ø': 'm7b5',
-            '°7': 'dim7',
-            '°': 'dim7',
-            'o7': 'dim7',
-            'Δ7': 'maj7',
-            'Δ': 'maj7',
-            'M': 'maj',
-        }
-        for pattern, replace in to_replace.items():
-            if pattern in chord:
-                prev = chord
-                chord = chord.replace(pattern, replace)
-                print('Pattern "{}": Replaced {} to {}'.format(pattern, prev, chord))
-        is_bms = chord.endswith('+')
+        if BuildTrace.enabled:
+            BuildTrace.emit('parse', note=chord)
+        text, origins = cls.expand(chord)
+        n = len(text)
+        is_bms = text.endswith('+')
         if is_bms:
-            chord = chord[:-1]
-
-        main = re.search(cls.BASE_PATTERS, chord)
-        chord = chord[len(main[1]):]
-        alterations = re.findall(cls.ALTERATIONS_PATTERN, chord)
-        add_bass = re.findall(cls.BASS_PATTERN, chord)
-
-        return dict(
-            tonic=main[1],
-            character=main[2],
-            modifier=main[3],
-            alterations=alterations,
-            bass_to_add=add_bass,
-            is_bms=is_bms
+            n -= 1
+
+        def error(message, i):
+            position = i if origins is None or i >= len(origins) else origins[i]
+            return ChordSyntaxError(message, chord, position)
+
+        head = cls.HEAD_PATTERN.match(text, 0, n)
+        if head is None:
+            raise error('Expected tonic (A-H)', 0)
+        tonic = head['tonic']
+        if tonic not in Note.INDEXES[0] and tonic not in Note.INDEXES[1]:
+            raise error('Unknown tonic "{}"'.format(tonic), 0)
+
+        extensions = list()
+        alterations = list()
+        omissions = list()
+        bass = list()
+        # quality and modifier letters are scanned for steps as well
+        for token in cls.TOKEN_PATTERN.finditer(text, head.end('tonic'), n):
+            op = token['op']
+            if op is None:
+                note = token['bass'] + (token['sign'] or token['step_sign'] or '')
+                if note not in Note.INDEXES[0] and note not in Note.INDEXES[1]:
+                    raise error('Unknown bass note "{}"'.format(note), token.start('bass'))
+                bass.append(note)
+                continue
+            step = int(token['step'])
+            if step > cls.MAX_STEP:
+                raise error('Step {} is past {}'.format(step, cls.MAX_STEP), token.start('step'))
+            if op in cls.EXTENSIONS:
+                extensions.append(Step(op, step))
+            elif op in cls.ALTERATIONS:
+                alterations.append(Step(op, step))
+            elif op in cls.OMISSIONS:
+                omissions.append(step)
+
+        return ChordSymbol(
+            tonic=tonic,
+            quality=head['quality'],
+            modifier=head['modifier'],
+            extensions=tuple(extensions),
+            alterations=tuple(alterations),
+            omissions=tuple(omissions),
+            bass=tuple(bass),
+            is_bms=is_bms,
         )
 
-    @staticmethod
-    def build(data):
+    @classmethod
+    def build(cls, symbol):
         """
         1. get steps amount, set steps in major
         2. modify tonic if minor
@@ -63,81 +216,257 @@ class ChordParser:
         5. modify last(?) if aug :todo
         6.(?) find lowest, then add bass note :todo
         """
+        return cls.extend(cls.build_base(symbol.tonic, symbol.quality), symbol)
+
+    @staticmethod
+    def build_base(tonic, character):
+        """ steps 1-2: the tonic with its character, shared by Am, Am7, Am9...
+        """
         # set tonic
-        tonic = data['tonic']
         chord = ChordBuilder(Note(tonic))
         # set character
-        character = data['character']
         major = 'maj', ''
         minor = 'm', 'min'
         sus4 = 'sus',
         if character in major:
             chord.maj()
-            chord.tonic.set_gamma(Note.MAJOR)
+            chord.steps[1] = chord.tonic.set_gamma(Note.MAJOR)
         elif character in minor:
             chord.min()
-            chord.tonic.set_gamma(Note.MINOR)
+            chord.steps[1] = chord.tonic.set_gamma(Note.MINOR)
         elif character in sus4:
             chord.maj()
             chord.sus(4)
+        return chord
+
+    @staticmethod
+    def extend(chord, symbol):
+        """ steps 3-6 on a base chord from build_base()
+        """
         # add additional steps
-        major = 'maj',
-        minor = '',
-        add = '/', 'add'
-        for cmd, attr in data['alterations']:
-            step = int(attr)
-            if cmd in major:
+        for cmd, step in symbol.extensions:
+            if cmd == 'maj':
                 chord.expand_to(step, maj=True)
-            elif cmd in minor:
+            elif cmd == '':
                 chord.expand_to(step)
                 # Special A5
                 if step == 5:
                     chord.omit(3)
-            elif cmd in add:
+            else:
                 chord.add_natural_major_step(step)
 
         # modify steps
         reduce = 'b', '-'
         enlarge = '#', '+'
-        sus = 'sus',
-        for cmd, attr in data['alterations']:
-            step = int(attr)
+        for cmd, step in symbol.alterations:
             if cmd in reduce:
                 chord.expand_to(step)
                 chord.reduce(step)
             elif cmd in enlarge:
                 chord.expand_to(step)
                 chord.enlarge(step)
-            elif cmd in sus:
+            else:
                 chord.sus(step)
         # omit notes
-        omit = 'no', 'omit'
-        for cmd, attr in data['alterations']:
-            step = int(attr)
-            if cmd in omit:
-                chord.omit(step)
+        for step in symbol.omissions:
+            chord.omit(step)
         # modify result
-        dim = 'dim',
-        aug = 'aug',
-        cmd = data['modifier']
-        if cmd in dim:
+        if symbol.modifier == 'dim':
             chord.dim()
-        elif cmd in aug or data['is_bms']:
+        elif symbol.modifier == 'aug' or symbol.is_bms:
             chord.aug()
         # add bass
-        for note in data['bass_to_add']:
+        for note in symbol.bass:
             chord.add_bass(note)
         return chord
 
+    @classmethod
+    def compile(cls, chord_name):
+        with Metrics.timer('chord_parse'):
+            chord_data = cls.parse(chord_name)
+        with Metrics.timer('chord_build'):
+            chord_obj = cls.build(chord_data)
+        if BuildTrace.enabled:
+            BuildTrace.emit('built', note=chord_obj)
+        return chord_obj.compile()
+
     @classmethod
     def chord(cls, chord_name):
-        chord_data = cls.parse(chord_name)
-        chord_obj = cls.build(chord_data)
-        print('→', chord_obj)
-        return chord_obj
+        symbol = cls.normalize(chord_name)
+        if cls.table is not None:
+            chord = cls.table.get(symbol)
+            if chord is not None:
+                return chord
+        return cls.cache.builder(symbol, cls.compile)
+
+    @classmethod
+    def chords(cls, symbols):
+        """ parse and build a whole progression in one call
+
+            Work is shared across the batch: every distinct symbol is
+            normalized and compiled once, and chords with the same tonic and
+            character (Am Am7 Am9 Am11) extend one shared base chord.
+            Returns a ChordResult(symbol, chord, error) per symbol, in order:
+            chord is a fresh ChordBuilder, or None with the ValueError.
+        """
+        bases = dict()
+
+        def compile_chord(symbol):
+            with Metrics.timer('chord_parse'):
+                data = cls.parse(symbol)
+            with Metrics.timer('chord_build'):
+                key = data.tonic, data.quality
+                base = bases.get(key)
+                if base is None:
+                    base = bases[key] = cls.build_base(data.tonic, data.quality).compile()
+                chord_obj = cls.extend(ChordBuilder.from_compiled(base), data)
+            if BuildTrace.enabled:
+                BuildTrace.emit('built', note=chord_obj)
+            return chord_obj.compile()
+
+        compiled = dict()
+        results = list()
+        for symbol in symbols:
+            found = compiled.get(symbol)
+            if found is None:
+                try:
+                    normalized = cls.normalize(symbol)
+                    chord = cls.table.get(normalized) if cls.table is not None else None
+                    if chord is not None:
+                        found = chord.compile()
+                    else:
+                        found = cls.cache.compiled(normalized, compile_chord)
+                except ValueError as error:
+                    found = error
+                compiled[symbol] = found
+            if isinstance(found, ValueError):
+                results.append(ChordResult(symbol, None, found))
+            else:
+                results.append(ChordResult(symbol, ChordBuilder.from_compiled(found), None))
+        return results
+
+    @classmethod
+    def progression(cls, text):
+        """ chords() of a whitespace separated progression or corpus text
+        """
+        return cls.chords(text.split())
+
+    @classmethod
+    def trace(cls, chord_name):
+        """ build chord_name bypassing the cache, return its debug output lines
+        """
+        with BuildTrace.capture() as events:
+            cls.compile(chord_name)
+        return [str(event) for event in events]
+
+    @classmethod
+    def warm(cls, symbols=None):
+        """ pre-compile symbols (the chords corpus by default) into the cache
+        """
+        if symbols is None:
+            symbols = corpus()
+        compiled = 0
+        for symbol in symbols:
+            try:
+                cls.chord(symbol)
+            except ValueError:
+                continue
+            compiled += 1
+        return compiled
+
+
+def corpus():
+    """ the chords corpus as a list of symbols
+    """
+    return [symbol.strip(',') for symbol in ' '.join(chords).split()]
+
+
+def benchmark(symbols=None, number=200):
+    """ ChordParser.parse throughput, symbols per second
+    """
+    if symbols is None:
+        symbols = corpus()
+    parse = ChordParser.parse
+    start = time.perf_counter()
+    for _ in range(number):
+        for symbol in symbols:
+            parse(symbol)
+    return len(symbols) * number / (time.perf_counter() - start)
+
+
+def benchmark_progression(size=50000, seed=0):
+    """ chords() against chord() per symbol on a synthetic progression of
+        random corpus chords over all tonics, cold cache and no table;
+        chords per second of each
+    """
+    suffixes = list()
+    for symbol in corpus():
+        try:
+            suffixes.append(symbol[len(ChordParser.parse(symbol).tonic):])
+        except ValueError:
+            continue
+    tonics = list(dict.fromkeys(Note.NAMES[0] + Note.NAMES[1]))
+    rng = random.Random(seed)
+    symbols = [rng.choice(tonics) + rng.choice(suffixes) for _ in range(size)]
+
+    table = ChordParser.table
+    ChordParser.table = None
+    rates = list()
+    try:
+        for run in (lambda: [ChordParser.chord(symbol) for symbol in symbols],
+                    lambda: ChordParser.chords(symbols)):
+            ChordParser.cache.clear()
+            start = time.perf_counter()
+            run()
+            rates.append(size / (time.perf_counter() - start))
+    finally:
+        ChordParser.table = table
+        ChordParser.cache.clear()
+    return rates
+
+
+def benchmark_diagrams(symbols=None, number=20):
+    """ Fretboard.get_schema and draw_voicing (best voicing) for every
+        chord of the corpus, cold then warm diagram cache; diagrams per
+        second of each
+    """
+    if symbols is None:
+        symbols = corpus()
+    fretboard = Fretboard()
+    chords = list()
+    for symbol in symbols:
+        try:
+            chord = ChordParser.chord(symbol)
+        except ValueError:
+            continue
+        voicings = fretboard.voicings(chord)
+        chords.append(([note.key for note in chord.steps.values()], voicings[0] if voicings else None, chord))
+
+    def draw():
+        for names, voicing, chord in chords:
+            fretboard.get_schema(names)
+            if voicing is not None:
+                fretboard.draw_voicing(voicing, chord)
+
+    count = sum(2 if voicing is not None else 1 for names, voicing, chord in chords)
+    fretboard.diagrams.clear()
+    start = time.perf_counter()
+    draw()
+    cold = count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(number):
+        draw()
+    return cold, count * number / (time.perf_counter() - start)
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        print('{:.0f} chords/s'.format(benchmark()))
+        print('progression: {:.0f} chords/s per chord, {:.0f} chords/s batch'.format(*benchmark_progression()))
+        print('diagrams: {:.0f}/s cold, {:.0f}/s warm'.format(*benchmark_diagrams()))
+        sys.exit()
+
+    BuildTrace.subscribe(print)
     accords = dict()
     for chord in 'Am/G,  Bbmaj13/11 ,Cm7b5 ,C°7 ,CØ, C-7 (b5)'.split(','): # + ['Am9+7', 'A5', 'Am', 'Am-6', 'Am6/9', 'A5', 'A7-5(+9)', 'Asus2', 'A13sus4', 'Aadd9', 'Am-6', 'Amaj13', 'Amaj7', 'A13', 'A11', 'A9', 'A7', 'A7+']:
         chord = chord.strip()
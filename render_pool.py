@@ -0,0 +1,74 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class PoolBusy(RuntimeError):
+    """ no room in a RenderPool within its timeout """
+
+
+class RenderPool:
+    """ Bounded pool running CPU-bound renders off the event loop
+
+        `workers` threads (or processes) run the calls and at most `pending`
+        more wait for one. Past that, run() waits up to `timeout` seconds
+        for room and then raises PoolBusy, so a burst is pushed back on the
+        callers instead of queued without bound. Process workers need
+        picklable functions and arguments (see generator.render).
+    """
+
+    def __init__(self, workers=None, processes=False, pending=None, timeout=5):
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = processes
+        self.pending = pending if pending is not None else 4 * self.workers
+        self.timeout = timeout
+        if processes:
+            self.executor = ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='render')
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.active = 0
+        # made on first use, inside the running loop
+        self._slots = None
+
+    async def run(self, function, *args, shard=None):
+        """ function(*args) in the pool; shard is for WorkerPool's sake
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers + self.pending)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PoolBusy('{} renders running or waiting'.format(self.active)) from None
+        self.submitted += 1
+        self.active += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+            self._slots.release()
+        self.completed += 1
+        return result
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    @property
+    def stats(self):
+        return dict(
+            workers=self.workers,
+            processes=self.processes,
+            pending=self.pending,
+            active=self.active,
+            submitted=self.submitted,
+            completed=self.completed,
+            failed=self.failed,
+            rejected=self.rejected,
+        )
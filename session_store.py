@@ -0,0 +1,158 @@
+import sqlite3
+import threading
+import time
+from generator import Generator
+from lru import LRUCache
+
+
+class MemoryBackend:
+    """ Session records in an LRU of at most `maxsize`: they outlive the
+        memory tier, not restarts
+    """
+
+    # whether calls do I/O, so async callers should run them in a thread
+    blocking = False
+
+    def __init__(self, maxsize=100000):
+        self._records = LRUCache(maxsize)
+
+    def load(self, user_id):
+        return self._records.get(user_id)
+
+    def save(self, user_id, data):
+        self._records.put(user_id, data)
+
+    def delete(self, user_id):
+        self._records.pop(user_id)
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self._records)
+
+
+class SqliteBackend:
+    """ Session records in an SQLite table (WAL journal), one row per user
+    """
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        # rows, kept up to date by save() and delete() so len() does not scan
+        self._count = self._db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._db.execute('SELECT data FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, user_id, data):
+        with self._lock:
+            if self._db.execute('UPDATE sessions SET data = ? WHERE user_id = ?', (data, user_id)).rowcount:
+                return
+            self._db.execute('INSERT INTO sessions (user_id, data) VALUES (?, ?)', (user_id, data))
+            self._count += 1
+
+    def delete(self, user_id):
+        with self._lock:
+            self._count -= self._db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        return self._count
+
+
+class SessionStore:
+    """ user id -> Generator, a bounded memory tier over a backend
+
+        The backend keeps every session as a compact record (encode()):
+        tempo, size and the chord symbols. At most `maxsize` Generators stay
+        in memory, least recently used first out, and those unused for `ttl`
+        seconds are dropped; both are rebuilt from their record on the next
+        get(). Changes reach the backend through save(). When the backend
+        is blocking, async code looks in memory with cached() and runs
+        load() and save() in a thread.
+    """
+
+    def __init__(self, backend=None, maxsize=10000, ttl=3600):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.loads = 0
+        self.created = 0
+        self._sessions = LRUCache(maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def encode(generator):
+        return '{} {!r} {}'.format(generator.tempo, generator.size, ' '.join(generator.symbols)).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        tempo, size, symbols = data.decode('utf-8').split(' ', 2)
+        generator = Generator(symbols)
+        generator.set_tempo(tempo)
+        generator.set_size(size)
+        return generator
+
+    def get(self, user_id):
+        """ the user's Generator, rehydrated or new if needed
+        """
+        generator = self.cached(user_id)
+        if generator is None:
+            generator = self.load(user_id)
+        return generator
+
+    def cached(self, user_id):
+        """ the user's Generator if it is in memory, else None
+        """
+        return self._sessions.get(user_id)
+
+    def load(self, user_id):
+        """ the user's Generator from the backend, or a new one, kept in memory
+        """
+        data = self.backend.load(user_id)
+        generator = self.decode(data) if data is not None else Generator()
+        with self._lock:
+            if data is not None:
+                self.loads += 1
+            else:
+                self.created += 1
+        return self._sessions.put(user_id, generator)
+
+    def save(self, user_id, generator):
+        self.backend.save(user_id, self.encode(generator))
+
+    def delete(self, user_id):
+        self._sessions.pop(user_id)
+        self.backend.delete(user_id)
+
+    def close(self):
+        self.backend.close()
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self._sessions.hits,
+            loads=self.loads,
+            created=self.created,
+            evictions=self._sessions.evictions,
+            size=len(self._sessions),
+            maxsize=self.maxsize,
+        )
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
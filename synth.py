@@ -0,0 +1,279 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import wave
+from io import BytesIO
+
+import numpy as np
+
+from lru import LRUCache
+from melody import Clock
+
+
+class SampleCache:
+    """ Shared, memory-budgeted cache of synthesized note samples
+
+        Keys are (midi key, bucket, timbre, sample rate), the bucket being
+        the sample length rounded up to a power of two, so notes of close
+        lengths share one sample. Samples are read-only float32 arrays,
+        safe to share across threads; past max_memory bytes the least
+        recently used go first. With a directory, samples are also kept
+        there as .npy files and loaded memory-mapped, so worker processes
+        on one machine share them through the page cache instead of each
+        synthesizing its own.
+    """
+
+    MIN_BUCKET = 1 << 12
+
+    def __init__(self, path=None, max_memory=64 << 20):
+        self.path = path
+        self.max_memory = max_memory
+        self.disk_hits = 0
+        self.misses = 0
+        self._samples = LRUCache(max_weight=max_memory, weigh=lambda sample: sample.nbytes)
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def bucket(cls, length):
+        return max(cls.MIN_BUCKET, 1 << (length - 1).bit_length())
+
+    def sample(self, midi_key, length, timbre, sample_rate, synthesize):
+        """ at least `length` samples of midi_key, synthesize(bucket) on a miss
+        """
+        key = midi_key, self.bucket(length), timbre, sample_rate
+        sample = self._samples.get(key)
+        if sample is not None:
+            return sample
+        sample = self._read(key)
+        if sample is None:
+            sample = synthesize(key[1])
+            sample.flags.writeable = False
+            if self.path is not None:
+                self._write(key, sample)
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.disk_hits += 1
+        return self._samples.put(key, sample)
+
+    def clear(self):
+        self._samples.clear()
+        with self._lock:
+            self.disk_hits = self.misses = 0
+
+    @property
+    def stats(self):
+        return dict(
+            hits=self._samples.hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            evictions=self._samples.evictions,
+            size=len(self._samples),
+            memory_bytes=self._samples.weight,
+        )
+
+    def __len__(self):
+        return len(self._samples)
+
+    def __contains__(self, key):
+        return key in self._samples
+
+    def _file(self, key):
+        midi_key, bucket, timbre, sample_rate = key
+        return os.path.join(self.path, '{}-{}-{}-{}.npy'.format(timbre, sample_rate, midi_key, bucket))
+
+    def _read(self, key):
+        if self.path is None:
+            return None
+        try:
+            return np.load(self._file(key), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key, sample):
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, sample)
+        os.replace(temp, self._file(key))
+
+
+class Synth:
+    """ Renders notes (tick, duration, midi key, channel, velocity), as
+        Generator.iter_notes gives them, to 16-bit mono PCM
+
+        Every midi key has a precomputed sample of its timbre: a
+        Karplus-Strong pluck ('pluck') or a few additive partials ('organ').
+        A chord (notes sharing start, duration and velocity) is the sum of
+        its keys' samples cut to length, shaped by one attack/release
+        envelope and overlap-added into a buffer allocated once for the
+        whole render. Keys sound at their midi frequency and tempo changes
+        (tick, tempo) move the notes after them, so the audio matches what a
+        player makes of the .mid file. Synths are shared per
+        (sample rate, timbre) via get(), samples by all of them in
+        `samples`, on disk too if chord_bot_samples names a directory (read
+        at import, so worker processes get the same one).
+    """
+
+    TIMBRES = 'pluck', 'organ'
+    ATTACK = 0.005
+    RELEASE = 0.05
+    # seconds for a pluck to fade by 60 dB
+    DECAY = 2.5
+    # organ partials: (harmonic, amplitude)
+    PARTIALS = (1, 1.0), (2, 0.5), (3, 0.25), (4, 0.125)
+    # longest render, as a preallocated buffer holds all of it
+    MAX_SECONDS = 600
+    HEADROOM = 0.9
+
+    samples = SampleCache(os.environ.get('chord_bot_samples'))
+
+    _synths = dict()
+
+    def __init__(self, sample_rate=22050, timbre='pluck'):
+        if timbre not in self.TIMBRES:
+            raise ValueError('Unknown timbre "{}"'.format(timbre))
+        self.sample_rate = sample_rate
+        self.timbre = timbre
+
+    @classmethod
+    def get(cls, sample_rate=22050, timbre='pluck'):
+        key = sample_rate, timbre
+        synth = cls._synths.get(key)
+        if synth is None:
+            synth = cls._synths[key] = cls(*key)
+        return synth
+
+    @staticmethod
+    def frequency(key):
+        return 440.0 * 2 ** ((key - 69) / 12)
+
+    def sample(self, key, length):
+        """ at least `length` samples of key's tone, at full velocity
+        """
+        synthesize = self._pluck if self.timbre == 'pluck' else self._organ
+        return self.samples.sample(key, length, self.timbre, self.sample_rate,
+                                   lambda length: synthesize(key, length))
+
+    def _pluck(self, key, length):
+        """ Karplus-Strong: y[n] = d * (y[n-P] + y[n-P-1]) / 2 from a burst
+            of noise, a period of P samples at a time
+        """
+        frequency = self.frequency(key)
+        period = max(2, int(round(self.sample_rate / frequency)))
+        decay = 1e-3 ** (1 / (frequency * self.DECAY))
+        # y[0] stands for y[-1] of the recurrence; seeded, so renders repeat
+        y = np.zeros(1 + period * (length // period + 2))
+        y[1:period + 1] = np.random.default_rng(key).uniform(-1, 1, period)
+        for start in range(1 + period, len(y), period):
+            y[start:start + period] = 0.5 * decay * (y[start - period:start] + y[start - period - 1:start - 1])
+        return y[1:length + 1].astype(np.float32)
+
+    def _organ(self, key, length):
+        frequency = self.frequency(key)
+        phase = 2 * np.pi * frequency / self.sample_rate * np.arange(length)
+        tone = np.zeros(length)
+        total = 0.0
+        for harmonic, amplitude in self.PARTIALS:
+            if harmonic * frequency < self.sample_rate / 2:
+                tone += amplitude * np.sin(harmonic * phase)
+                total += amplitude
+        return (tone / total).astype(np.float32)
+
+    def envelope(self, length):
+        attack = min(length, int(self.ATTACK * self.sample_rate))
+        release = min(length - attack, int(self.RELEASE * self.sample_rate))
+        envelope = np.ones(length, dtype=np.float32)
+        envelope[:attack] = np.linspace(0, 1, attack, endpoint=False)
+        envelope[length - release:] = np.linspace(1, 0, release)
+        return envelope
+
+    def render(self, notes, tempo=120, ticks_per_quarter=960, tempos=()):
+        """ float32 samples in [-1, 1] of notes at tempo
+        """
+        chords = list()
+        for tick, duration, key, channel, velocity in notes:
+            if chords and chords[-1][:3] == (tick, duration, velocity):
+                chords[-1][3].append(key)
+            else:
+                chords.append((tick, duration, velocity, [key]))
+        samples_per_tick = 60 / tempo / ticks_per_quarter * self.sample_rate
+        clock = None
+        if tempos:
+            clock = Clock(samples_per_tick, [(tick, 60 / changed / ticks_per_quarter * self.sample_rate)
+                                             for tick, changed in tempos])
+        release = int(self.RELEASE * self.sample_rate)
+        end = max((tick + duration for tick, duration, velocity, keys in chords), default=0)
+        if clock is None:
+            length = int(round(end * samples_per_tick)) + release
+        else:
+            length = int(round(clock.time(end))) + release
+        if length > self.MAX_SECONDS * self.sample_rate:
+            raise ValueError('{:.0f}s of audio is more than {}s'.format(length / self.sample_rate, self.MAX_SECONDS))
+        out = np.zeros(length, dtype=np.float32)
+        envelopes = dict()
+        for tick, duration, velocity, keys in chords:
+            if clock is None:
+                start = int(round(tick * samples_per_tick))
+                size = int(round(duration * samples_per_tick)) + release
+            else:
+                start = int(round(clock.time(tick)))
+                size = int(round(clock.time(tick + duration))) - start + release
+            envelope = envelopes.get(size)
+            if envelope is None:
+                envelope = envelopes[size] = self.envelope(size)
+            chord = np.stack([self.sample(key, size)[:size] for key in keys]).sum(axis=0)
+            chord *= envelope
+            chord *= velocity / 127
+            out[start:start + size] += chord[:length - start]
+        peak = np.abs(out).max(initial=0)
+        if peak > self.HEADROOM:
+            out *= self.HEADROOM / peak
+        return out
+
+    def pcm(self, notes, tempo=120, ticks_per_quarter=960, tempos=()):
+        """ render() as little-endian 16-bit PCM bytes
+        """
+        return (self.render(notes, tempo, ticks_per_quarter, tempos) * 32767).astype('<i2').tobytes()
+
+    def wav(self, notes, tempo=120, ticks_per_quarter=960, tempos=()):
+        """ pcm() in a WAV file, as bytes
+        """
+        wav_io = BytesIO()
+        with wave.open(wav_io, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.sample_rate)
+            f.writeframes(self.pcm(notes, tempo, ticks_per_quarter, tempos))
+        return wav_io.getvalue()
+
+
+def benchmark(length=4000, timbre='pluck', sample_rate=22050):
+    """ render speed of a `length` character progression as a multiple of
+        real time: (audio seconds, cold render seconds, warm render seconds,
+        multiple when warm); cold renders synthesize every sample
+    """
+    from generator import Generator
+    gen = Generator('Am Dm G C F Bb E7 Am9 Dm7')
+    melody_str = ('1_2.3__4 5-6.7_8 9...1-2-' * (length // 24 + 1))[:length]
+    notes = list(gen.iter_notes(melody_str))
+    synth = Synth.get(sample_rate, timbre)
+    timings = list()
+    for cache in ('cold', 'warm'):
+        if cache == 'cold':
+            Synth.samples.clear()
+        start = time.perf_counter()
+        audio = len(synth.render(notes, gen.tempo)) / sample_rate
+        timings.append(time.perf_counter() - start)
+    return (audio,) + tuple(timings) + (audio / timings[1],)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        for timbre in Synth.TIMBRES:
+            print('{}: {:.0f}s of audio, {:.3f}s cold, {:.3f}s warm, {:.0f}x real time'.format(
+                timbre, *benchmark(timbre=timbre)))
@@ -0,0 +1,356 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from render_pool import PoolBusy
+
+
+class WorkerLost(RuntimeError):
+    """ the worker running a job went away before answering """
+
+
+class JobTimeout(WorkerLost):
+    """ the worker running a job didn't answer within the pool's job_timeout """
+
+
+def parse_address(address):
+    """ "host:port" -> (host, port), anything else is a Unix socket path
+    """
+    host, colon, port = address.rpartition(':')
+    if colon and port.isdigit():
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+def serve(address, authkey, heartbeat=1.0):
+    """ worker loop: run the jobs sent over a connection to a WorkerPool
+
+        Jobs are (job id, function, args); answers are ('done', job id, ok,
+        result or exception, seconds). A ('heartbeat',) goes out whenever
+        no job came for `heartbeat` seconds.
+    """
+    conn = Client(address, authkey=authkey)
+    conn.send(('hello', os.getpid(), socket.gethostname()))
+    try:
+        while True:
+            if not conn.poll(heartbeat):
+                conn.send(('heartbeat',))
+                continue
+            job = conn.recv()
+            if job is None:
+                break
+            job_id, function, args = job
+            start = time.perf_counter()
+            try:
+                answer = True, function(*args)
+            except Exception as e:
+                answer = False, e
+            seconds = time.perf_counter() - start
+            try:
+                conn.send(('done', job_id) + answer + (seconds,))
+            except Exception as e:
+                # the result or exception didn't pickle
+                conn.send(('done', job_id, False, RuntimeError(repr(e)), seconds))
+    except (EOFError, OSError):
+        pass
+    finally:
+        conn.close()
+
+
+class Worker:
+    """ front side of one connected worker
+    """
+
+    def __init__(self, worker_id, conn, pid, host, process=None):
+        self.id = worker_id
+        self.conn = conn
+        self.pid = pid
+        self.host = host
+        self.process = process
+        self.alive = True
+        self.started = time.monotonic()
+        self.last_seen = self.started
+        self.jobs = set()
+        self.completed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self._send_lock = threading.Lock()
+
+    def send(self, job):
+        with self._send_lock:
+            self.conn.send(job)
+
+    @property
+    def stats(self):
+        now = time.monotonic()
+        return dict(
+            id=self.id,
+            pid=self.pid,
+            host=self.host,
+            alive=self.alive,
+            in_flight=len(self.jobs),
+            completed=self.completed,
+            failed=self.failed,
+            busy_seconds=round(self.busy, 3),
+            utilization=round(self.busy / max(now - self.started, 1e-9), 3),
+            last_seen=round(now - self.last_seen, 3),
+        )
+
+
+class WorkerPool:
+    """ Render jobs run by worker processes, local or on other machines
+
+        The pool listens on `address` ("host:port" or a Unix socket path, a
+        fresh Unix socket by default) and starts `workers` local processes
+        that connect to it; more can join from elsewhere with
+        `python workers.py ADDRESS` and the same authkey
+        (chord_bot_authkey). run() sends a job to the worker picked by
+        `shard` (a user id keeps a user on one worker while the set of
+        workers stays the same), with RenderPool's backpressure: at most
+        `pending` jobs in flight, PoolBusy after `timeout` seconds without
+        room. Jobs of a worker that dies fail with WorkerLost and a local
+        worker is replaced. A job without an answer after `job_timeout`
+        seconds fails with JobTimeout and its worker is dropped as hung,
+        so it can't hold up the rest of its shard.
+    """
+
+    def __init__(self, workers=None, address=None, authkey=None, pending=None, timeout=5, heartbeat=1.0,
+                 job_timeout=60):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.local_workers = workers
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.pending = pending if pending is not None else 8 * max(workers, 1)
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.job_timeout = job_timeout
+        if address is None:
+            self.listener = Listener(family='AF_UNIX', authkey=self.authkey)
+        else:
+            self.listener = Listener(parse_address(address), authkey=self.authkey)
+        self.address = self.listener.address
+        self.started = time.monotonic()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.lost = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self._workers = dict()
+        self._jobs = dict()
+        self._job_ids = itertools.count()
+        self._worker_ids = itertools.count()
+        self._processes = list()
+        self._lock = threading.Lock()
+        self._joined = threading.Condition(self._lock)
+        self._closing = False
+        self._slots = None
+        self._context = multiprocessing.get_context('spawn')
+        threading.Thread(target=self._accept, name='worker-accept', daemon=True).start()
+        for _ in range(workers):
+            self._spawn()
+
+    def _spawn(self):
+        process = self._context.Process(target=serve, args=(self.address, self.authkey, self.heartbeat), daemon=True)
+        process.start()
+        with self._lock:
+            self._processes.append(process)
+
+    def wait_workers(self, count=None, timeout=30):
+        """ block until `count` workers (the local ones by default) joined
+        """
+        count = self.local_workers if count is None else count
+        with self._joined:
+            return self._joined.wait_for(lambda: len(self._workers) >= count, timeout)
+
+    def _accept(self):
+        while not self._closing:
+            try:
+                conn = self.listener.accept()
+                kind, pid, host = conn.recv()
+            except (OSError, EOFError):
+                if self._closing:
+                    return
+                continue
+            with self._lock:
+                process = next((p for p in self._processes if p.pid == pid), None)
+                worker = Worker(next(self._worker_ids), conn, pid, host, process)
+                self._workers[worker.id] = worker
+                self._joined.notify_all()
+            threading.Thread(target=self._read, args=(worker,), name='worker-{}'.format(worker.id),
+                             daemon=True).start()
+
+    def _read(self, worker):
+        try:
+            while True:
+                message = worker.conn.recv()
+                worker.last_seen = time.monotonic()
+                if message[0] == 'done':
+                    self._finish(worker, *message[1:])
+        except (EOFError, OSError):
+            pass
+        self._lose(worker)
+
+    def _finish(self, worker, job_id, ok, result, seconds):
+        with self._lock:
+            entry = self._jobs.pop(job_id, None)
+            worker.jobs.discard(job_id)
+            worker.busy += seconds
+            if ok:
+                worker.completed += 1
+                self.completed += 1
+            else:
+                worker.failed += 1
+                self.failed += 1
+        if entry is not None:
+            future, loop = entry
+            loop.call_soon_threadsafe(self._resolve, future, ok, result)
+
+    @staticmethod
+    def _resolve(future, ok, result):
+        if future.done():
+            return
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+    def _lose(self, worker):
+        with self._lock:
+            if not worker.alive:
+                return
+            worker.alive = False
+            self._workers.pop(worker.id, None)
+            lost = [self._jobs.pop(job_id) for job_id in worker.jobs if job_id in self._jobs]
+            worker.jobs.clear()
+            self.lost += len(lost)
+            if worker.process is not None:
+                self._processes.remove(worker.process)
+        worker.conn.close()
+        for future, loop in lost:
+            loop.call_soon_threadsafe(self._resolve, future, False,
+                                      WorkerLost('worker {} ({}) went away'.format(worker.id, worker.host)))
+        if worker.process is not None and not self._closing:
+            self._spawn()
+
+    def _drop(self, worker):
+        """ cut off a hung worker: a local process is killed (and replaced),
+            the connection is shut down so its reader stops too
+        """
+        if worker.process is not None:
+            worker.process.kill()
+        try:
+            with socket.socket(fileno=os.dup(worker.conn.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._lose(worker)
+
+    def _pick(self, shard):
+        with self._lock:
+            workers = sorted(self._workers)
+            if not workers:
+                return None
+            if shard is None:
+                worker_id = min(workers, key=lambda worker_id: len(self._workers[worker_id].jobs))
+            else:
+                worker_id = workers[hash(shard) % len(workers)]
+            return self._workers[worker_id]
+
+    async def run(self, function, *args, shard=None):
+        """ function(*args) on a worker; function and args must pickle
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pending)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PoolBusy('{} jobs in flight'.format(len(self._jobs))) from None
+        try:
+            worker = self._pick(shard)
+            if worker is None:
+                self.rejected += 1
+                raise PoolBusy('no workers')
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            job_id = next(self._job_ids)
+            with self._lock:
+                self._jobs[job_id] = future, loop
+                worker.jobs.add(job_id)
+                self.submitted += 1
+            try:
+                worker.send((job_id, function, args))
+            except OSError:
+                self._lose(worker)
+            except Exception:
+                # the job didn't pickle, so nothing was sent
+                with self._lock:
+                    self._jobs.pop(job_id, None)
+                    worker.jobs.discard(job_id)
+                    self.failed += 1
+                raise
+            try:
+                return await asyncio.wait_for(future, self.job_timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self._jobs.pop(job_id, None)
+                    worker.jobs.discard(job_id)
+                    self.timed_out += 1
+                self._drop(worker)
+                raise JobTimeout('worker {} ({}) took over {} s'.format(
+                    worker.id, worker.host, self.job_timeout)) from None
+        finally:
+            self._slots.release()
+
+    def health(self):
+        """ workers that answered within three heartbeats
+        """
+        now = time.monotonic()
+        with self._lock:
+            workers = list(self._workers.values())
+        return {worker.id: worker.alive and now - worker.last_seen < 3 * self.heartbeat for worker in workers}
+
+    @property
+    def stats(self):
+        uptime = time.monotonic() - self.started
+        with self._lock:
+            workers = [worker.stats for worker in self._workers.values()]
+        return dict(
+            address=self.address,
+            workers=workers,
+            pending=self.pending,
+            in_flight=len(self._jobs),
+            submitted=self.submitted,
+            completed=self.completed,
+            failed=self.failed,
+            lost=self.lost,
+            timed_out=self.timed_out,
+            rejected=self.rejected,
+            throughput=round(self.completed / uptime, 3),
+        )
+
+    def shutdown(self, wait=True):
+        self._closing = True
+        with self._lock:
+            workers = list(self._workers.values())
+            processes = list(self._processes)
+        for worker in workers:
+            try:
+                worker.send(None)
+            except OSError:
+                pass
+        self.listener.close()
+        if wait:
+            for process in processes:
+                process.join(self.timeout)
+
+
+if __name__ == '__main__':
+    # python workers.py ADDRESS: serve a front started with chord_bot_listen=ADDRESS
+    serve(parse_address(sys.argv[1]), os.environ['chord_bot_authkey'].encode())